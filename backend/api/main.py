@@ -1,21 +1,42 @@
-from fastapi import FastAPI, Depends, HTTPException, status
+from fastapi import BackgroundTasks, FastAPI, Depends, HTTPException, Header, Query, Request, status
+from fastapi.concurrency import run_in_threadpool
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 from fastapi.middleware.cors import CORSMiddleware
-from sqlalchemy import create_engine, Column, Integer, String, Float, DateTime, Text, Boolean, ForeignKey, Index
+from fastapi.responses import PlainTextResponse
+from fastapi.routing import APIRoute
+from sqlalchemy import event, create_engine, Column, Integer, String, Float, DateTime, Text, Boolean, ForeignKey, Index, func, insert, select, update
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, Session, relationship
-from pydantic import BaseModel
-from typing import List, Optional
+from pydantic import BaseModel, Field
+from typing import Callable, List, Optional, Tuple
 from datetime import datetime, timedelta
-from passlib.context import CryptContext
-from jose import JWTError, jwt
+from functools import lru_cache, wraps
+from contextlib import contextmanager
+from contextvars import ContextVar
+from collections import Counter, OrderedDict, defaultdict, deque, namedtuple
+import asyncio
+import bisect
+import cProfile
+import gzip
+import itertools
 import json
+import logging
+import math
+import os
+import pstats
+import secrets
+import sys
 import uuid
+import zlib
 import re
 import random
+import threading
+import time
+
+logger = logging.getLogger(__name__)
 
 # Database setup with optimizations
-SQLALCHEMY_DATABASE_URL = "sqlite:///./ecommerce.db"
+SQLALCHEMY_DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./ecommerce.db")
 engine = create_engine(
     SQLALCHEMY_DATABASE_URL, 
     connect_args={"check_same_thread": False},
@@ -30,7 +51,6 @@ SECRET_KEY = "your-secret-key-here-change-in-production"
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="auth/login")
 
 app = FastAPI(title="E-commerce Chatbot API", version="2.0.0")
@@ -42,6 +62,7 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["Retry-After"],
 )
 
 # Enhanced Database Models with indexes for performance
@@ -68,23 +89,92 @@ class Product(Base):
     image_url = Column(String)
     rating = Column(Float, index=True)
     stock = Column(Integer)
-    features = Column(Text)  # JSON string
-    tags = Column(Text)  # JSON string for better search
     created_at = Column(DateTime, default=datetime.utcnow)
     
+    # Loaded with one IN query per relationship for every batch of products
+    tag_links = relationship("ProductTag", order_by="ProductTag.position", lazy="selectin", cascade="all, delete-orphan")
+    feature_rows = relationship("ProductFeature", order_by="ProductFeature.position", lazy="selectin", cascade="all, delete-orphan")
+    
     # Add indexes for better query performance
     __table_args__ = (
         Index('idx_product_search', 'name', 'category', 'brand'),
         Index('idx_product_price_rating', 'price', 'rating'),
     )
+    
+    @property
+    def tags(self) -> List[str]:
+        return [link.tag.name for link in self.tag_links]
+    
+    @property
+    def features(self) -> List[str]:
+        return [row.text for row in self.feature_rows]
+
+class Tag(Base):
+    """Tag dictionary; products refer to tags by integer id"""
+    __tablename__ = "tags"
+    
+    id = Column(Integer, primary_key=True)
+    name = Column(String, unique=True, nullable=False)
+
+class ProductTag(Base):
+    __tablename__ = "product_tags"
+    
+    product_id = Column(Integer, ForeignKey("products.id"), primary_key=True)
+    position = Column(Integer, primary_key=True)
+    tag_id = Column(Integer, ForeignKey("tags.id"), nullable=False)
+    
+    tag = relationship("Tag", lazy="joined", innerjoin=True)
+    
+    # Tag filters look up products by tag id
+    __table_args__ = (
+        Index('idx_product_tags_tag', 'tag_id', 'product_id'),
+    )
+
+class ProductFeature(Base):
+    __tablename__ = "product_features"
+    
+    product_id = Column(Integer, ForeignKey("products.id"), primary_key=True)
+    position = Column(Integer, primary_key=True)
+    text = Column(String, nullable=False)
+
+class ProductChange(Base):
+    """Log of product value changes that worker processes poll, in seq order"""
+    __tablename__ = "product_changes"
+    
+    seq = Column(Integer, primary_key=True)
+    product_id = Column(Integer)  # NULL: catalog reloaded, rebuild everything
+    price = Column(Float)
+    rating = Column(Float)
+    stock = Column(Integer)
+    changed_at = Column(DateTime, default=datetime.utcnow)
+    
+    __table_args__ = {"sqlite_autoincrement": True}
+
+class ProductNeighbor(Base):
+    """Precomputed "similar products" lists, one row per (product, rank)"""
+    __tablename__ = "product_neighbors"
+    
+    product_id = Column(Integer, ForeignKey("products.id"), primary_key=True)
+    rank = Column(Integer, primary_key=True)
+    neighbor_id = Column(Integer, ForeignKey("products.id"))
+    score = Column(Float)
+
+class SimilarityTerm(Base):
+    """Vocabulary and IDF weights of the last full similarity build"""
+    __tablename__ = "similarity_terms"
+    
+    position = Column(Integer, primary_key=True)
+    term = Column(String, nullable=False)
+    idf = Column(Float, nullable=False)
 
 class ChatSession(Base):
     __tablename__ = "chat_sessions"
     
-    id = Column(String, primary_key=True, index=True)
+    id = Column(String, primary_key=True)
     user_id = Column(Integer, ForeignKey("users.id"), index=True)
     created_at = Column(DateTime, default=datetime.utcnow)
-    updated_at = Column(DateTime, default=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow, index=True)
+    context = Column(Text)  # compact JSON ConversationState
     
     user = relationship("User", back_populates="chat_sessions")
     messages = relationship("ChatMessage", back_populates="session")
@@ -92,7 +182,7 @@ class ChatSession(Base):
 class ChatMessage(Base):
     __tablename__ = "chat_messages"
     
-    id = Column(String, primary_key=True, index=True)
+    id = Column(String, primary_key=True)
     session_id = Column(String, ForeignKey("chat_sessions.id"), index=True)
     content = Column(Text)
     sender = Column(String)  # 'user' or 'bot'
@@ -101,7 +191,103 @@ class ChatMessage(Base):
     
     session = relationship("ChatSession", back_populates="messages")
 
-Base.metadata.create_all(bind=engine)
+class ChatArchiveEntry(Base):
+    """Where an archived session lives; the session itself is in the gzip archive"""
+    __tablename__ = "chat_archive_index"
+    
+    session_id = Column(String, primary_key=True)
+    user_id = Column(Integer, index=True)
+    archive_day = Column(String)  # YYYY-MM-DD, names the archive file
+    message_count = Column(Integer)
+    archived_at = Column(DateTime, default=datetime.utcnow)
+
+# Schema versioning: the version is stamped into SQLite's `user_version` pragma
+# so startup only has to read one integer instead of inspecting every table.
+SCHEMA_VERSION = 7
+
+def _migration_create_tables(conn):
+    Base.metadata.create_all(bind=conn)
+
+def _migration_product_neighbors(conn):
+    Base.metadata.create_all(bind=conn, tables=[ProductNeighbor.__table__])
+
+def _add_column(conn, table: str, column: str, ddl: str):
+    # Fresh databases already got the column from create_all in migration 1
+    existing = {row[1] for row in conn.exec_driver_sql(f"PRAGMA table_info({table})")}
+    if column not in existing:
+        conn.exec_driver_sql(f"ALTER TABLE {table} ADD COLUMN {column} {ddl}")
+
+def _migration_session_context(conn):
+    _add_column(conn, "chat_sessions", "context", "TEXT")
+
+def _migration_chat_retention(conn):
+    Base.metadata.create_all(bind=conn, tables=[ChatArchiveEntry.__table__])
+    # Primary keys are already indexed; these duplicates only slowed inserts
+    conn.exec_driver_sql("DROP INDEX IF EXISTS ix_chat_sessions_id")
+    conn.exec_driver_sql("DROP INDEX IF EXISTS ix_chat_messages_id")
+    conn.exec_driver_sql("CREATE INDEX IF NOT EXISTS ix_chat_sessions_updated_at ON chat_sessions (updated_at)")
+    # Compaction scans that index directly, so every session needs a value
+    conn.exec_driver_sql("UPDATE chat_sessions SET updated_at = coalesce(created_at, CURRENT_TIMESTAMP) WHERE updated_at IS NULL")
+
+def _migration_normalized_attributes(conn):
+    Base.metadata.create_all(bind=conn, tables=[Tag.__table__, ProductTag.__table__, ProductFeature.__table__])
+    columns = {row[1] for row in conn.exec_driver_sql("PRAGMA table_info(products)")}
+    if "tags" not in columns:
+        return
+    rows = conn.exec_driver_sql("SELECT id, tags, features FROM products").fetchall()
+    store_product_attributes(conn, [
+        (product_id, json.loads(tags) if tags else [], json.loads(features) if features else [])
+        for product_id, tags, features in rows
+    ])
+    conn.exec_driver_sql("ALTER TABLE products DROP COLUMN tags")
+    conn.exec_driver_sql("ALTER TABLE products DROP COLUMN features")
+
+def _migration_product_changes(conn):
+    Base.metadata.create_all(bind=conn, tables=[ProductChange.__table__])
+
+def _migration_similarity_terms(conn):
+    Base.metadata.create_all(bind=conn, tables=[SimilarityTerm.__table__])
+
+# MIGRATIONS[n] upgrades a database from version n to n + 1
+MIGRATIONS = [
+    _migration_create_tables,
+    _migration_product_neighbors,
+    _migration_session_context,
+    _migration_chat_retention,
+    _migration_normalized_attributes,
+    _migration_product_changes,
+    _migration_similarity_terms,
+]
+
+MIGRATION_LOCK_TIMEOUT_MS = int(os.getenv("MIGRATION_LOCK_TIMEOUT_MS", "120000"))
+
+def get_schema_version(conn) -> int:
+    return conn.exec_driver_sql("PRAGMA user_version").scalar() or 0
+
+def migrate_database() -> int:
+    """Apply pending migrations and stamp the schema version marker.
+
+    Workers cold-starting together all see an old version, and some
+    migrations (DROP COLUMN) fail if run twice. BEGIN IMMEDIATE takes
+    SQLite's write lock up front, so one process migrates while the others
+    wait, then re-read the version and find nothing left to do.
+    """
+    with engine.connect() as conn:
+        # The default 5s busy timeout is shorter than a large backfill
+        conn.exec_driver_sql(f"PRAGMA busy_timeout = {MIGRATION_LOCK_TIMEOUT_MS}")
+        conn.exec_driver_sql("BEGIN IMMEDIATE")
+        try:
+            version = get_schema_version(conn)
+            for step in range(version, SCHEMA_VERSION):
+                MIGRATIONS[step](conn)
+                conn.exec_driver_sql(f"PRAGMA user_version = {step + 1}")
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+        finally:
+            conn.exec_driver_sql("PRAGMA busy_timeout = 5000")
+    return SCHEMA_VERSION
 
 # Enhanced Pydantic models
 class UserCreate(BaseModel):
@@ -149,20 +335,496 @@ class ChatResponse(BaseModel):
     products: Optional[List[ProductResponse]] = None
     session_id: str
 
+class ChatBatchRequest(BaseModel):
+    messages: List[ChatMessageRequest]
+
+class ChatBatchResponse(BaseModel):
+    results: List[ChatResponse]
+
+class ArchivedMessage(BaseModel):
+    id: str
+    sender: str
+    content: str
+    timestamp: Optional[datetime] = None
+    product_ids: List[int] = []
+
+class ArchivedSession(BaseModel):
+    session_id: str
+    created_at: Optional[datetime] = None
+    updated_at: Optional[datetime] = None
+    messages: List[ArchivedMessage]
+
+class CompactionRequest(BaseModel):
+    # Zero or less would archive sessions that are still in use
+    older_than_days: Optional[float] = Field(None, gt=0)
+    vacuum: bool = True
+
+class ProfilingConfig(BaseModel):
+    sample_rate: Optional[float] = None
+    slow_ms: Optional[float] = None
+
+class SimilarRebuildRequest(BaseModel):
+    product_ids: Optional[List[int]] = None
+
+class ProductUpdate(BaseModel):
+    price: Optional[float] = None
+    rating: Optional[float] = None
+    stock: Optional[int] = None
+    stock_delta: Optional[int] = None  # e.g. -1 for a sale; applied atomically
+
+class ProductBatchUpdateItem(ProductUpdate):
+    product_id: int
+
+class ProductBatchUpdateRequest(BaseModel):
+    updates: List[ProductBatchUpdateItem]
+
+class ProductBatchUpdateResponse(BaseModel):
+    updated: List[int]
+    missing: List[int]
+
+class FacetValue(BaseModel):
+    value: str
+    count: int
+
+class FacetCounts(BaseModel):
+    total: int
+    categories: List[FacetValue]
+    brands: List[FacetValue]
+    tags: List[FacetValue]
+
 class CategoryStats(BaseModel):
     category: str
     count: int
     avg_price: float
     avg_rating: float
 
+# Performance instrumentation
+# Per-request timings are collected into a RequestMetrics object held in a
+# context variable; the middleware folds them into process-wide aggregates
+# that /metrics renders in the Prometheus text format.
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "true").lower() in ("1", "true", "yes")
+SLOW_QUERY_MS = float(os.getenv("SLOW_QUERY_MS", "100"))
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class RequestMetrics:
+    """Timings collected for a single request"""
+    __slots__ = ("db_queries", "db_seconds", "phases")
+    
+    def __init__(self):
+        self.db_queries = 0
+        self.db_seconds = 0.0
+        self.phases = {}
+
+current_request_metrics: ContextVar[Optional[RequestMetrics]] = ContextVar("current_request_metrics", default=None)
+
+@contextmanager
+def track_phase(name: str):
+    """Add the time spent in the block to the current request's `name` phase.
+
+    Phases may overlap with DB time (e.g. `auth` includes the user lookup).
+    Outside a request this is a no-op.
+    """
+    request_metrics = current_request_metrics.get()
+    if request_metrics is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        request_metrics.phases[name] = request_metrics.phases.get(name, 0.0) + time.perf_counter() - started
+
+class MetricsRegistry:
+    """Process-wide request aggregates, rendered in Prometheus text format"""
+    
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._latency = {}  # (method, route) -> [per-bucket counts..., +Inf count]
+        self._latency_sum = {}
+        self._requests = {}  # (method, route, status) -> count
+        self._phases = {}  # (method, route, phase) -> seconds
+        self._db_queries = {}
+        self._db_seconds = {}
+        self._slow_queries = 0
+        self._admission_rejections = {}  # reason -> count
+    
+    def observe(self, method: str, route: str, status_code: int, seconds: float, request_metrics: RequestMetrics):
+        key = (method, route)
+        bucket = bisect.bisect_left(self.buckets, seconds)
+        with self._lock:
+            counts = self._latency.get(key)
+            if counts is None:
+                counts = self._latency[key] = [0] * (len(self.buckets) + 1)
+            counts[bucket] += 1
+            self._latency_sum[key] = self._latency_sum.get(key, 0.0) + seconds
+            status_key = (method, route, str(status_code))
+            self._requests[status_key] = self._requests.get(status_key, 0) + 1
+            self._db_queries[key] = self._db_queries.get(key, 0) + request_metrics.db_queries
+            self._db_seconds[key] = self._db_seconds.get(key, 0.0) + request_metrics.db_seconds
+            for phase, phase_seconds in request_metrics.phases.items():
+                phase_key = (method, route, phase)
+                self._phases[phase_key] = self._phases.get(phase_key, 0.0) + phase_seconds
+    
+    def record_slow_query(self):
+        with self._lock:
+            self._slow_queries += 1
+    
+    def record_admission_rejection(self, reason: str):
+        with self._lock:
+            self._admission_rejections[reason] = self._admission_rejections.get(reason, 0) + 1
+    
+    def render(self) -> str:
+        def labels(**values):
+            return ",".join(f'{k}="{v}"' for k, v in values.items())
+        
+        with self._lock:
+            lines = [
+                "# HELP http_request_duration_seconds Request latency by route",
+                "# TYPE http_request_duration_seconds histogram",
+            ]
+            for (method, route), counts in sorted(self._latency.items()):
+                cumulative = 0
+                for le, count in zip(self.buckets + ("+Inf",), counts):
+                    cumulative += count
+                    lines.append(f"http_request_duration_seconds_bucket{{{labels(method=method, route=route, le=le)}}} {cumulative}")
+                lines.append(f"http_request_duration_seconds_sum{{{labels(method=method, route=route)}}} {self._latency_sum[(method, route)]:.6f}")
+                lines.append(f"http_request_duration_seconds_count{{{labels(method=method, route=route)}}} {cumulative}")
+            
+            lines += ["# HELP http_requests_total Requests by route and status", "# TYPE http_requests_total counter"]
+            for (method, route, status_code), count in sorted(self._requests.items()):
+                lines.append(f"http_requests_total{{{labels(method=method, route=route, status=status_code)}}} {count}")
+            
+            lines += ["# HELP http_request_phase_seconds_total Time spent per request phase", "# TYPE http_request_phase_seconds_total counter"]
+            for (method, route, phase), seconds in sorted(self._phases.items()):
+                lines.append(f"http_request_phase_seconds_total{{{labels(method=method, route=route, phase=phase)}}} {seconds:.6f}")
+            
+            lines += ["# HELP db_queries_total SQL statements executed by route", "# TYPE db_queries_total counter"]
+            for (method, route), count in sorted(self._db_queries.items()):
+                lines.append(f"db_queries_total{{{labels(method=method, route=route)}}} {count}")
+            
+            lines += ["# HELP db_query_seconds_total Time spent executing SQL by route", "# TYPE db_query_seconds_total counter"]
+            for (method, route), seconds in sorted(self._db_seconds.items()):
+                lines.append(f"db_query_seconds_total{{{labels(method=method, route=route)}}} {seconds:.6f}")
+            
+            lines += [
+                f"# HELP db_slow_queries_total SQL statements slower than {SLOW_QUERY_MS:g} ms",
+                "# TYPE db_slow_queries_total counter",
+                f"db_slow_queries_total {self._slow_queries}",
+            ]
+            
+            lines += ["# HELP chat_admission_rejections_total Chat requests refused with 429", "# TYPE chat_admission_rejections_total counter"]
+            for reason, count in sorted(self._admission_rejections.items()):
+                lines.append(f"chat_admission_rejections_total{{{labels(reason=reason)}}} {count}")
+        return "\n".join(lines) + "\n"
+
+metrics_registry = MetricsRegistry()
+
+class MetricsMiddleware:
+    """Pure ASGI middleware timing each request against its route template"""
+    
+    def __init__(self, app):
+        self.app = app
+    
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        
+        request_metrics = RequestMetrics()
+        token = current_request_metrics.set(request_metrics)
+        status_code = 500
+        
+        async def send_with_status(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+        
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            elapsed = time.perf_counter() - started
+            current_request_metrics.reset(token)
+            # Route templates keep label cardinality bounded; unknown paths share one label
+            route = scope.get("route")
+            metrics_registry.observe(scope["method"], getattr(route, "path", "unmatched"), status_code, elapsed, request_metrics)
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_start_time", []).append(time.perf_counter())
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info["query_start_time"].pop()
+    request_metrics = current_request_metrics.get()
+    if request_metrics is not None:
+        request_metrics.db_queries += 1
+        request_metrics.db_seconds += elapsed
+    if elapsed * 1000 >= SLOW_QUERY_MS:
+        metrics_registry.record_slow_query()
+        # Bulk inserts can carry thousands of parameter sets; keep the log line bounded
+        shown = repr(parameters)
+        if len(shown) > 500:
+            shown = shown[:500] + f"... ({len(parameters)} parameter sets)" if executemany else shown[:500] + "..."
+        logger.warning("Slow query (%.1f ms): %s | parameters=%s", elapsed * 1000, statement, shown)
+
+if METRICS_ENABLED:
+    app.add_middleware(MetricsMiddleware)
+    event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(engine, "after_cursor_execute", _after_cursor_execute)
+
+# Opt-in request profiling
+# Requests are either cProfiled at random (PROFILE_SAMPLE_RATE) or, once they
+# run past PROFILE_SLOW_MS, stack-sampled by a background thread. Results land
+# in a bounded ring buffer exposed under /admin/profiles.
+#
+# Both follow the thread doing the request's work: the event loop thread for
+# async endpoints, the threadpool thread for sync `def` endpoints. A cProfile
+# on the loop thread also counts every other coroutine the loop runs in the
+# meantime, so each profile records how many requests overlapped it; treat
+# profiles with overlap > 0 as approximate.
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+PROFILE_SLOW_MS = float(os.getenv("PROFILE_SLOW_MS", "0"))
+PROFILE_BUFFER_SIZE = int(os.getenv("PROFILE_BUFFER_SIZE", "50"))
+PROFILE_TOP_N = int(os.getenv("PROFILE_TOP_N", "30"))
+PROFILE_SAMPLE_INTERVAL_MS = float(os.getenv("PROFILE_SAMPLE_INTERVAL_MS", "5"))
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")
+
+current_profile_notes: ContextVar[Optional[dict]] = ContextVar("current_profile_notes", default=None)
+current_profile_run: ContextVar[Optional["ProfileRun"]] = ContextVar("current_profile_run", default=None)
+
+def note_request_context(**notes):
+    """Attach details (e.g. the chat message) to the current request's profile, if any"""
+    profile_notes = current_profile_notes.get()
+    if profile_notes is not None:
+        profile_notes.update(notes)
+
+def _folded_stack(frame, max_depth: int = 64) -> str:
+    """Render a frame's stack root-first in the `a;b;c` folded format used by flame graphs"""
+    parts = []
+    while frame is not None and len(parts) < max_depth:
+        code = frame.f_code
+        parts.append(f"{os.path.basename(code.co_filename)}:{frame.f_lineno}({code.co_name})")
+        frame = frame.f_back
+    return ";".join(reversed(parts))
+
+class StackSampler:
+    """Background thread sampling the stacks of requests that overran their deadline.
+
+    Async endpoints run their (synchronous) DB and parsing work on the event
+    loop thread, so while a slow request is blocking, that thread's stack is
+    the slow request's stack. Sync endpoints `move` the watch to their
+    threadpool thread for as long as they run.
+    """
+    
+    def __init__(self, interval_ms: float):
+        self.interval = interval_ms / 1000
+        self._watched = {}  # token -> (thread id, deadline, Counter of folded stacks)
+        self._tokens = itertools.count()
+        self._lock = threading.Lock()
+        self._thread = None
+    
+    def watch(self, deadline: float) -> int:
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name="stack-sampler", daemon=True)
+                    self._thread.start()
+        token = next(self._tokens)
+        with self._lock:
+            self._watched[token] = (threading.get_ident(), deadline, Counter())
+        return token
+    
+    def unwatch(self, token: int) -> Counter:
+        with self._lock:
+            return self._watched.pop(token)[2]
+    
+    def move(self, token: int, thread_id: int) -> int:
+        """Sample `thread_id` for this request from now on; returns the thread sampled so far"""
+        with self._lock:
+            previous, deadline, samples = self._watched[token]
+            self._watched[token] = (thread_id, deadline, samples)
+        return previous
+    
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            now = time.perf_counter()
+            with self._lock:
+                due = [(thread_id, samples) for thread_id, deadline, samples in self._watched.values() if now >= deadline]
+            if not due:
+                continue
+            frames = sys._current_frames()
+            for thread_id, samples in due:
+                frame = frames.get(thread_id)
+                if frame is not None:
+                    samples[_folded_stack(frame)] += 1
+
+class ProfileRun:
+    """Profiling state of one request, reachable from the threadpool through a ContextVar"""
+    
+    def __init__(self, profile: Optional[cProfile.Profile], watch: Optional[int], in_flight: int, started_total: int):
+        self.profile = profile
+        self.watch = watch
+        self.thread_profiles = []
+        # Requests already running, and the request counter, when this one started
+        self.in_flight = in_flight
+        self.started_total = started_total
+
+class RequestProfiler:
+    """Holds the profiling configuration and the ring buffer of captured profiles"""
+    
+    def __init__(self, sample_rate: float, slow_ms: float, buffer_size: int, top_n: int, sample_interval_ms: float):
+        self.sample_rate = sample_rate
+        self.slow_ms = slow_ms
+        self.top_n = top_n
+        self.profiles = deque(maxlen=buffer_size)
+        self.sampler = StackSampler(sample_interval_ms)
+        self._ids = itertools.count(1)
+        # Only one cProfile can be active at a time; concurrent picks are skipped
+        self._cprofile_lock = threading.Lock()
+        # Only touched from the event loop thread
+        self.in_flight = 0
+        self.started_total = 0
+    
+    @property
+    def enabled(self) -> bool:
+        return self.sample_rate > 0 or self.slow_ms > 0
+    
+    def start_cprofile(self) -> Optional[cProfile.Profile]:
+        if not self._cprofile_lock.acquire(blocking=False):
+            return None
+        profile = cProfile.Profile()
+        profile.enable()
+        return profile
+    
+    def stop_cprofile(self, profile: cProfile.Profile, thread_profiles: list = ()) -> list:
+        profile.disable()
+        self._cprofile_lock.release()
+        stats = pstats.Stats(profile)
+        for thread_profile in thread_profiles:
+            stats.add(thread_profile)
+        stats = stats.stats
+        top = sorted(stats.items(), key=lambda item: item[1][3], reverse=True)[:self.top_n]
+        return [
+            {
+                "function": f"{os.path.basename(filename)}:{line}({name})",
+                "calls": calls,
+                "total_ms": round(total_time * 1000, 3),
+                "cumulative_ms": round(cumulative_time * 1000, 3),
+            }
+            for (filename, line, name), (_, calls, total_time, cumulative_time, _) in top
+        ]
+    
+    @contextmanager
+    def threadpool_call(self, run: ProfileRun):
+        """Profile a sync endpoint on the threadpool thread that runs it"""
+        thread_profile = None
+        if run.profile is not None:
+            # cProfile is per thread before Python 3.12; from 3.12 on the loop
+            # thread's profile already sees every thread and a second one is refused
+            thread_profile = cProfile.Profile()
+            try:
+                thread_profile.enable()
+            except ValueError:
+                thread_profile = None
+        previous = self.sampler.move(run.watch, threading.get_ident()) if run.watch is not None else None
+        try:
+            yield
+        finally:
+            if thread_profile is not None:
+                thread_profile.disable()
+                run.thread_profiles.append(thread_profile)
+            if run.watch is not None:
+                self.sampler.move(run.watch, previous)
+    
+    def summarize_samples(self, samples: Counter) -> list:
+        return [{"stack": stack, "samples": count} for stack, count in samples.most_common(self.top_n)]
+    
+    def store(self, scope, duration: float, mode: str, top: list, notes: dict, overlapping: int):
+        route = scope.get("route")
+        self.profiles.append({
+            "id": next(self._ids),
+            "captured_at": datetime.utcnow().isoformat(),
+            "method": scope["method"],
+            "route": getattr(route, "path", "unmatched"),
+            "path": scope["path"],
+            "query_string": scope.get("query_string", b"").decode("latin-1"),
+            "duration_ms": round(duration * 1000, 3),
+            "mode": mode,
+            "overlapping_requests": overlapping,
+            "notes": notes,
+            "top": top,
+        })
+
+request_profiler = RequestProfiler(
+    PROFILE_SAMPLE_RATE, PROFILE_SLOW_MS, PROFILE_BUFFER_SIZE, PROFILE_TOP_N, PROFILE_SAMPLE_INTERVAL_MS
+)
+
+class ProfilingMiddleware:
+    """Pure ASGI middleware; a no-op until sampling or a slow threshold is configured"""
+    
+    def __init__(self, app):
+        self.app = app
+    
+    async def __call__(self, scope, receive, send):
+        profiler = request_profiler
+        # Don't fill the buffer with profiles of the endpoints used to read it
+        if scope["type"] != "http" or not profiler.enabled or scope["path"].startswith("/admin/"):
+            await self.app(scope, receive, send)
+            return
+        
+        notes = {}
+        notes_token = current_profile_notes.set(notes)
+        profile = profiler.start_cprofile() if random.random() < profiler.sample_rate else None
+        watch = None
+        started = time.perf_counter()
+        if profile is None and profiler.slow_ms > 0:
+            watch = profiler.sampler.watch(started + profiler.slow_ms / 1000)
+        run = ProfileRun(profile, watch, profiler.in_flight, profiler.started_total)
+        run_token = current_profile_run.set(run)
+        profiler.in_flight += 1
+        profiler.started_total += 1
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            elapsed = time.perf_counter() - started
+            profiler.in_flight -= 1
+            current_profile_run.reset(run_token)
+            current_profile_notes.reset(notes_token)
+            overlapping = run.in_flight + profiler.started_total - run.started_total - 1
+            if profile is not None:
+                profiler.store(scope, elapsed, "cprofile", profiler.stop_cprofile(profile, run.thread_profiles), notes, overlapping)
+            elif watch is not None:
+                samples = profiler.sampler.unwatch(watch)
+                if samples and elapsed * 1000 >= profiler.slow_ms:
+                    profiler.store(scope, elapsed, "stack_sampling", profiler.summarize_samples(samples), notes, overlapping)
+
+app.add_middleware(ProfilingMiddleware)
+
+def require_admin(x_admin_token: Optional[str] = Header(None)):
+    """Guard for operational endpoints; disabled unless ADMIN_TOKEN is set"""
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Admin endpoints are disabled")
+    if not x_admin_token or not secrets.compare_digest(x_admin_token, ADMIN_TOKEN):
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid admin token")
+
 # Utility functions
+# passlib and jose are imported on first use so they stay off the cold-start path
+@lru_cache(maxsize=1)
+def get_pwd_context():
+    from passlib.context import CryptContext
+    return CryptContext(schemes=["bcrypt"], deprecated="auto")
+
 def get_password_hash(password):
-    return pwd_context.hash(password)
+    return get_pwd_context().hash(password)
 
 def verify_password(plain_password, hashed_password):
-    return pwd_context.verify(plain_password, hashed_password)
+    return get_pwd_context().verify(plain_password, hashed_password)
 
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
+    from jose import jwt
+
     to_encode = data.copy()
     if expires_delta:
         expire = datetime.utcnow() + expires_delta
@@ -172,6 +834,81 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
+def product_to_response(p: Product) -> ProductResponse:
+    return ProductResponse(
+        id=p.id,
+        name=p.name,
+        description=p.description,
+        price=p.price,
+        category=p.category,
+        brand=p.brand,
+        image_url=p.image_url,
+        rating=p.rating,
+        stock=p.stock,
+        features=p.features,
+        tags=p.tags
+    )
+
+def normalize_tag(name: str) -> str:
+    return name.strip().lower()
+
+def resolve_tag_ids(conn, names) -> dict:
+    """Map tag names to dictionary ids, adding any names not seen before.
+
+    Works on a Session or a Connection so migrations can share it.
+    """
+    names = {normalize_tag(name) for name in names}
+    if not names:
+        return {}
+    known = dict(conn.execute(select(Tag.name, Tag.id).where(Tag.name.in_(names))).all())
+    missing = names - known.keys()
+    if missing:
+        conn.execute(insert(Tag), [{"name": name} for name in sorted(missing)])
+        known.update(conn.execute(select(Tag.name, Tag.id).where(Tag.name.in_(missing))).all())
+    return known
+
+def store_product_attributes(conn, attributes):
+    """Bulk-insert tag links and features from (product_id, tags, features) tuples"""
+    attributes = list(attributes)
+    tag_ids = resolve_tag_ids(conn, (tag for _, tags, _ in attributes for tag in tags))
+    tag_rows = []
+    feature_rows = []
+    for product_id, tags, features in attributes:
+        seen = set()
+        for tag in tags:
+            tag_id = tag_ids[normalize_tag(tag)]
+            if tag_id not in seen:
+                seen.add(tag_id)
+                tag_rows.append({"product_id": product_id, "position": len(seen) - 1, "tag_id": tag_id})
+        feature_rows.extend(
+            {"product_id": product_id, "position": position, "text": feature}
+            for position, feature in enumerate(features)
+        )
+    if tag_rows:
+        conn.execute(insert(ProductTag), tag_rows)
+    if feature_rows:
+        conn.execute(insert(ProductFeature), feature_rows)
+
+def insert_products(db: Session, rows: List[dict]) -> List[int]:
+    """Bulk-insert product dicts carrying plain `tags`/`features` lists; returns the new ids"""
+    product_rows = [{k: v for k, v in row.items() if k not in ("tags", "features")} for row in rows]
+    ids = db.execute(insert(Product).returning(Product.id, sort_by_parameter_order=True), product_rows).scalars().all()
+    store_product_attributes(db, [
+        (product_id, row.get("tags", []), row.get("features", []))
+        for product_id, row in zip(ids, rows)
+    ])
+    log_catalog_reload(db)
+    return ids
+
+def tag_matches(pattern: str):
+    """Filter for products with a tag matching an ILIKE pattern.
+
+    The pattern is checked against the small tag dictionary only; products
+    are then found through the (tag_id, product_id) index.
+    """
+    matching_tags = select(Tag.id).where(Tag.name.ilike(pattern))
+    return Product.id.in_(select(ProductTag.product_id).where(ProductTag.tag_id.in_(matching_tags)))
+
 def get_db():
     db = SessionLocal()
     try:
@@ -179,28 +916,41 @@ def get_db():
     finally:
         db.close()
 
-async def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
-    credentials_exception = HTTPException(
+def credentials_exception() -> HTTPException:
+    return HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
+
+def token_subject(token: str) -> str:
+    """Username a bearer token was issued to; checks the signature but not the database"""
+    from jose import JWTError, jwt
+
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
         username: str = payload.get("sub")
         if username is None:
-            raise credentials_exception
+            raise credentials_exception()
     except JWTError:
-        raise credentials_exception
-    
-    user = db.query(User).filter(User.username == username).first()
-    if user is None:
-        raise credentials_exception
-    return user
+        raise credentials_exception()
+    return username
+
+async def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
+    with track_phase("auth"):
+        username = token_subject(token)
+        user = db.query(User).filter(User.username == username).first()
+        if user is None:
+            raise credentials_exception()
+        return user
 
 # Enhanced sample data with 150+ products
-def init_sample_data(db: Session):
-    if db.query(Product).count() == 0:
+def init_sample_data(db: Session, count: int = 150, seed: Optional[int] = None, batch_size: int = 5000):
+    """Seed the catalog with the curated products plus generated ones up to `count`.
+
+    Used by the `seed` command only; it never runs on the request path.
+    """
+    if db.query(Product.id).first() is None:
         # Comprehensive product categories with realistic data
         product_data = [
             # Electronics - Smartphones
@@ -434,76 +1184,72 @@ def init_sample_data(db: Session):
             }
         ]
         
-        # Generate additional products to reach 150+
+        # Generate additional products to reach `count`
+        rng = random.Random(seed)
         categories = ["Electronics", "Computers", "Audio", "Gaming", "Smart Home", "Cameras", "Wearables", "Accessories"]
         brands = ["Apple", "Samsung", "Sony", "Dell", "HP", "Google", "Amazon", "Microsoft", "Nintendo", "Bose", "Canon", "Nikon", "Fitbit", "Garmin", "Logitech", "Razer", "ASUS", "Acer", "LG", "Xiaomi"]
         
+        # Realistic product names based on category
+        product_names = {
+            "Electronics": ["Smartphone", "Tablet", "Smart TV", "Wireless Charger", "Power Bank"],
+            "Computers": ["Laptop", "Desktop", "Monitor", "Keyboard", "Mouse"],
+            "Audio": ["Headphones", "Speakers", "Soundbar", "Earbuds", "Microphone"],
+            "Gaming": ["Controller", "Gaming Chair", "Mechanical Keyboard", "Gaming Mouse", "Headset"],
+            "Smart Home": ["Smart Bulb", "Security Camera", "Thermostat", "Door Lock", "Sensor"],
+            "Cameras": ["DSLR Camera", "Action Camera", "Lens", "Tripod", "Flash"],
+            "Wearables": ["Fitness Tracker", "Smart Ring", "VR Headset", "Smart Glasses"],
+            "Accessories": ["Case", "Screen Protector", "Cable", "Adapter", "Stand"]
+        }
+        
         # Add the main products first
-        for product_data in product_data:
-            product = Product(
-                name=product_data["name"],
-                description=product_data["description"],
-                price=product_data["price"],
-                category=product_data["category"],
-                brand=product_data["brand"],
-                image_url=product_data["image_url"],
-                rating=product_data["rating"],
-                stock=product_data["stock"],
-                features=json.dumps(product_data["features"]),
-                tags=json.dumps(product_data["tags"])
-            )
-            db.add(product)
+        rows = list(product_data[:count])
         
-        # Generate additional products
-        for i in range(len(product_data), 150):
-            category = random.choice(categories)
-            brand = random.choice(brands)
+        for i in range(len(rows), count):
+            category = rng.choice(categories)
+            brand = rng.choice(brands)
+            base_name = rng.choice(product_names.get(category, ["Device"]))
+            model_suffix = rng.choice(["Pro", "Max", "Ultra", "Plus", "Elite", "Premium", "Advanced", "X", "Series", "Gen"])
             
-            # Generate realistic product names based on category
-            product_names = {
-                "Electronics": ["Smartphone", "Tablet", "Smart TV", "Wireless Charger", "Power Bank"],
-                "Computers": ["Laptop", "Desktop", "Monitor", "Keyboard", "Mouse"],
-                "Audio": ["Headphones", "Speakers", "Soundbar", "Earbuds", "Microphone"],
-                "Gaming": ["Controller", "Gaming Chair", "Mechanical Keyboard", "Gaming Mouse", "Headset"],
-                "Smart Home": ["Smart Bulb", "Security Camera", "Thermostat", "Door Lock", "Sensor"],
-                "Cameras": ["DSLR Camera", "Action Camera", "Lens", "Tripod", "Flash"],
-                "Wearables": ["Fitness Tracker", "Smart Ring", "VR Headset", "Smart Glasses"],
-                "Accessories": ["Case", "Screen Protector", "Cable", "Adapter", "Stand"]
-            }
-            
-            base_name = random.choice(product_names.get(category, ["Device"]))
-            model_suffix = random.choice(["Pro", "Max", "Ultra", "Plus", "Elite", "Premium", "Advanced", "X", "Series", "Gen"])
+            rows.append({
+                "name": f"{brand} {base_name} {model_suffix} {i+1}",
+                "description": f"High-quality {base_name.lower()} from {brand} with advanced features and premium build quality. Perfect for {category.lower()} enthusiasts.",
+                "price": round(rng.uniform(29.99, 2999.99), 2),
+                "category": category,
+                "brand": brand,
+                "image_url": f"https://images.pexels.com/photos/{200000 + i}/pexels-photo-{200000 + i}.jpeg",
+                "rating": round(rng.uniform(3.5, 5.0), 1),
+                "stock": rng.randint(0, 100),
+                "features": [f"Feature A", f"Feature B", f"Premium {category} technology", f"{brand} quality"],
+                "tags": [category.lower(), brand.lower(), base_name.lower(), "premium"]
+            })
             
-            product = Product(
-                name=f"{brand} {base_name} {model_suffix} {i+1}",
-                description=f"High-quality {base_name.lower()} from {brand} with advanced features and premium build quality. Perfect for {category.lower()} enthusiasts.",
-                price=round(random.uniform(29.99, 2999.99), 2),
-                category=category,
-                brand=brand,
-                image_url=f"https://images.pexels.com/photos/{200000 + i}/pexels-photo-{200000 + i}.jpeg",
-                rating=round(random.uniform(3.5, 5.0), 1),
-                stock=random.randint(0, 100),
-                features=json.dumps([f"Feature A", f"Feature B", f"Premium {category} technology", f"{brand} quality"]),
-                tags=json.dumps([category.lower(), brand.lower(), base_name.lower(), "premium"])
-            )
-            db.add(product)
+            # Flush in batches so large benchmark catalogs don't sit in memory
+            if len(rows) >= batch_size:
+                insert_products(db, rows)
+                rows = []
         
+        if rows:
+            insert_products(db, rows)
         db.commit()
 
-# Initialize sample data on startup
+# Startup only checks the schema marker; seeding is the `seed` command's job
 @app.on_event("startup")
 async def startup_event():
-    db = SessionLocal()
-    try:
-        init_sample_data(db)
-    finally:
-        db.close()
-
+    with engine.connect() as conn:
+        version = get_schema_version(conn)
+    if version < SCHEMA_VERSION:
+        logger.info("Database schema at version %s, migrating to %s", version, SCHEMA_VERSION)
+        migrate_database()
 
 @app.get("/")
 def read_root():
     return {"message": "Hello from FastAPI on Vercel!"}
 
+@app.get("/metrics", include_in_schema=False)
+def get_metrics():
+    """Prometheus scrape endpoint"""
+    return PlainTextResponse(metrics_registry.render(), media_type="text/plain; version=0.0.4")
+
 # Auth endpoints
 @app.post("/auth/register", response_model=Token)
 async def register(user: UserCreate, db: Session = Depends(get_db)):
@@ -525,7 +1271,8 @@ async def register(user: UserCreate, db: Session = Depends(get_db)):
         hashed_password=hashed_password
     )
     db.add(db_user)
-    db.commit()
+    with track_phase("commit"):
+        db.commit()
     db.refresh(db_user)
     
     # Create access token
@@ -542,8 +1289,10 @@ async def register(user: UserCreate, db: Session = Depends(get_db)):
 
 @app.post("/auth/login", response_model=Token)
 async def login(form_data: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(get_db)):
-    user = db.query(User).filter(User.username == form_data.username).first()
-    if not user or not verify_password(form_data.password, user.hashed_password):
+    with track_phase("auth"):
+        user = db.query(User).filter(User.username == form_data.username).first()
+        authenticated = user is not None and verify_password(form_data.password, user.hashed_password)
+    if not authenticated:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Incorrect username or password",
@@ -569,99 +1318,122 @@ async def get_profile(current_user: User = Depends(get_current_user)):
 @app.get("/products/search", response_model=List[ProductResponse])
 async def search_products(
     q: str = "",
-    category: Optional[str] = None,
-    brand: Optional[str] = None,
+    category: Optional[List[str]] = Query(None),
+    brand: Optional[List[str]] = Query(None),
+    tags: Optional[List[str]] = Query(None),
+    tag_match: str = "all",
     min_price: Optional[float] = None,
     max_price: Optional[float] = None,
     min_rating: Optional[float] = None,
     in_stock: Optional[bool] = None,
     limit: int = 20,
     offset: int = 0,
+    semantic: bool = False,
     db: Session = Depends(get_db)
 ):
-    query = db.query(Product)
+    """Search the catalog.
+
+    `category` and `brand` can be repeated and match any of the values.
+    `tags` takes repeated or comma-separated values and requires all of them,
+    or any of them with `tag_match=any`. Filters run on the in-memory bitmap
+    index; only the text match for `q` goes to the database.
+    """
+    if tag_match not in ("all", "any"):
+        raise HTTPException(status_code=400, detail="tag_match must be 'all' or 'any'")
+    
+    index = get_filter_index(db)
+    mask = index.select(
+        categories=split_filter_values(category),
+        brands=split_filter_values(brand),
+        tags=split_filter_values(tags),
+        match_all_tags=tag_match == "all",
+        min_price=min_price,
+        max_price=max_price,
+        min_rating=min_rating,
+        in_stock=bool(in_stock)
+    )
     
+    wanted = offset + limit
     if q:
         search_term = f"%{q}%"
-        query = query.filter(
+        text_filter = (
             Product.name.ilike(search_term) | 
             Product.description.ilike(search_term) |
             Product.brand.ilike(search_term) |
             Product.category.ilike(search_term) |
-            Product.tags.ilike(search_term)
+            tag_matches(search_term)
         )
+        keyword_ids = ranked_text_matches(db, index, mask, text_filter, wanted)
+    else:
+        keyword_ids = index.ranked_ids(mask, 0, wanted)
     
-    if category:
-        query = query.filter(Product.category == category)
-    
-    if brand:
-        query = query.filter(Product.brand == brand)
-    
-    if min_price is not None:
-        query = query.filter(Product.price >= min_price)
-    
-    if max_price is not None:
-        query = query.filter(Product.price <= max_price)
-    
-    if min_rating is not None:
-        query = query.filter(Product.rating >= min_rating)
-    
-    if in_stock:
-        query = query.filter(Product.stock > 0)
-    
-    # Order by relevance (rating and stock)
-    query = query.order_by(Product.rating.desc(), Product.stock.desc())
+    # Ranked by rating, then stock
+    if semantic and q:
+        # Fuse keyword and embedding rankings, then paginate the fused list
+        keyword_products = load_products_in_order(db, keyword_ids)
+        products = fuse_semantic_results(
+            q, keyword_products, db.query(Product), wanted,
+            allowed=lambda product_id: index.contains(mask, product_id)
+        )[offset:]
+    else:
+        products = load_products_in_order(db, keyword_ids[offset:])
     
-    products = query.offset(offset).limit(limit).all()
+    with track_phase("serialize"):
+        return [product_to_response(p) for p in products]
+
+@app.get("/products/facets", response_model=FacetCounts)
+async def get_product_facets(
+    category: Optional[List[str]] = Query(None),
+    brand: Optional[List[str]] = Query(None),
+    tags: Optional[List[str]] = Query(None),
+    tag_match: str = "all",
+    min_price: Optional[float] = None,
+    max_price: Optional[float] = None,
+    min_rating: Optional[float] = None,
+    in_stock: Optional[bool] = None,
+    tag_limit: int = 50,
+    db: Session = Depends(get_db)
+):
+    """Category, brand and tag counts for the products matching the same filters as /products/search"""
+    if tag_match not in ("all", "any"):
+        raise HTTPException(status_code=400, detail="tag_match must be 'all' or 'any'")
     
-    return [
-        ProductResponse(
-            id=p.id,
-            name=p.name,
-            description=p.description,
-            price=p.price,
-            category=p.category,
-            brand=p.brand,
-            image_url=p.image_url,
-            rating=p.rating,
-            stock=p.stock,
-            features=json.loads(p.features) if p.features else [],
-            tags=json.loads(p.tags) if p.tags else []
+    index = get_filter_index(db)
+    categories, brands, tag_values = split_filter_values(category), split_filter_values(brand), split_filter_values(tags)
+    if not (categories or brands or tag_values) and min_price is None and max_price is None and min_rating is None:
+        # The whole catalog (or everything in stock): answer from the maintained counters
+        return FacetCounts(
+            total=int(index.in_stock_counts["category"].sum()) if in_stock else len(index.product_ids),
+            categories=index.counter_facets("category", bool(in_stock)),
+            brands=index.counter_facets("brand", bool(in_stock)),
+            tags=index.counter_facets("tag", bool(in_stock), tag_limit)
         )
-        for p in products
-    ]
+    
+    mask = index.select(
+        categories=categories,
+        brands=brands,
+        tags=tag_values,
+        match_all_tags=tag_match == "all",
+        min_price=min_price,
+        max_price=max_price,
+        min_rating=min_rating,
+        in_stock=bool(in_stock)
+    )
+    return FacetCounts(
+        total=int(mask.sum()),
+        categories=index.facet_counts(mask, "category"),
+        brands=index.facet_counts(mask, "brand"),
+        tags=index.facet_counts(mask, "tag", tag_limit)
+    )
 
 @app.get("/products/categories", response_model=List[CategoryStats])
 async def get_categories(db: Session = Depends(get_db)):
-    from sqlalchemy import func
-    
-    categories = db.query(
-        Product.category,
-        func.count(Product.id).label('count'),
-        func.avg(Product.price).label('avg_price'),
-        func.avg(Product.rating).label('avg_rating')
-    ).group_by(Product.category).all()
-    
-    return [
-        CategoryStats(
-            category=cat.category,
-            count=cat.count,
-            avg_price=round(cat.avg_price, 2),
-            avg_rating=round(cat.avg_rating, 1)
-        )
-        for cat in categories
-    ]
+    # Running per-category sums in the filter index, kept current from the change log
+    return get_filter_index(db).category_stats()
 
 @app.get("/products/brands")
 async def get_brands(db: Session = Depends(get_db)):
-    from sqlalchemy import func
-    
-    brands = db.query(
-        Product.brand,
-        func.count(Product.id).label('count')
-    ).group_by(Product.brand).order_by(func.count(Product.id).desc()).all()
-    
-    return [{"brand": brand.brand, "count": brand.count} for brand in brands]
+    return [{"brand": facet["value"], "count": facet["count"]} for facet in get_filter_index(db).counter_facets("brand")]
 
 @app.get("/products/featured", response_model=List[ProductResponse])
 async def get_featured_products(limit: int = 12, db: Session = Depends(get_db)):
@@ -671,22 +1443,8 @@ async def get_featured_products(limit: int = 12, db: Session = Depends(get_db)):
         Product.stock > 0
     ).order_by(Product.rating.desc()).limit(limit).all()
     
-    return [
-        ProductResponse(
-            id=p.id,
-            name=p.name,
-            description=p.description,
-            price=p.price,
-            category=p.category,
-            brand=p.brand,
-            image_url=p.image_url,
-            rating=p.rating,
-            stock=p.stock,
-            features=json.loads(p.features) if p.features else [],
-            tags=json.loads(p.tags) if p.tags else []
-        )
-        for p in products
-    ]
+    with track_phase("serialize"):
+        return [product_to_response(p) for p in products]
 
 @app.get("/products/trending", response_model=List[ProductResponse])
 async def get_trending_products(limit: int = 8, db: Session = Depends(get_db)):
@@ -696,33 +1454,349 @@ async def get_trending_products(limit: int = 8, db: Session = Depends(get_db)):
         Product.stock > 5
     ).order_by(func.random()).limit(limit).all()
     
-    return [
-        ProductResponse(
-            id=p.id,
-            name=p.name,
-            description=p.description,
-            price=p.price,
-            category=p.category,
-            brand=p.brand,
-            image_url=p.image_url,
-            rating=p.rating,
-            stock=p.stock,
-            features=json.loads(p.features) if p.features else [],
-            tags=json.loads(p.tags) if p.tags else []
-        )
-        for p in products
-    ]
+    with track_phase("serialize"):
+        return [product_to_response(p) for p in products]
+
+@app.get("/products/{product_id}/similar", response_model=List[ProductResponse])
+async def get_similar_products_endpoint(product_id: int, limit: int = 6, db: Session = Depends(get_db)):
+    """Products most like this one, from the precomputed neighbor lists"""
+    if db.get(Product, product_id) is None:
+        raise HTTPException(status_code=404, detail="Product not found")
+    products = get_similar_products(db, product_id, limit)
+    
+    with track_phase("serialize"):
+        return [product_to_response(p) for p in products]
+
+# Catalog updates
+# Writes go through the change log so every worker's indexes follow along
+@app.patch("/products/{product_id}", response_model=ProductResponse, dependencies=[Depends(require_admin)])
+def update_product(product_id: int, update: ProductUpdate, background_tasks: BackgroundTasks, db: Session = Depends(get_db)):
+    """Set price, rating or stock, or adjust stock by `stock_delta`"""
+    values = product_update_values(update)
+    _, missing = apply_product_updates(db, [(product_id, values)])
+    if missing:
+        raise HTTPException(status_code=404, detail="Product not found")
+    if "price" in values:
+        background_tasks.add_task(refresh_repriced_neighbors, [product_id])
+    return product_to_response(db.get(Product, product_id))
+
+@app.post("/products:batch-update", response_model=ProductBatchUpdateResponse, dependencies=[Depends(require_admin)])
+def batch_update_products(request: ProductBatchUpdateRequest, background_tasks: BackgroundTasks, db: Session = Depends(get_db)):
+    """Apply many updates in one transaction; unknown product ids are reported, not fatal"""
+    if not request.updates:
+        raise HTTPException(status_code=400, detail="No updates given")
+    if len(request.updates) > PRODUCT_BATCH_MAX_UPDATES:
+        raise HTTPException(status_code=400, detail=f"At most {PRODUCT_BATCH_MAX_UPDATES} updates per request")
+    updates = [(item.product_id, product_update_values(item)) for item in request.updates]
+    updated, missing = apply_product_updates(db, updates)
+    missing_ids = set(missing)
+    repriced = [product_id for product_id, values in updates if "price" in values and product_id not in missing_ids]
+    if repriced:
+        background_tasks.add_task(refresh_repriced_neighbors, repriced)
+    return ProductBatchUpdateResponse(updated=updated, missing=missing)
+
+# Admin: profiling
+@app.get("/admin/profiling", dependencies=[Depends(require_admin)])
+async def get_profiling_config():
+    return {
+        "sample_rate": request_profiler.sample_rate,
+        "slow_ms": request_profiler.slow_ms,
+        "buffer_size": request_profiler.profiles.maxlen,
+        "captured": len(request_profiler.profiles),
+    }
+
+@app.put("/admin/profiling", dependencies=[Depends(require_admin)])
+async def update_profiling_config(config: ProfilingConfig):
+    """Change sampling at runtime, e.g. to chase a latency spike without redeploying"""
+    if config.sample_rate is not None:
+        if not 0 <= config.sample_rate <= 1:
+            raise HTTPException(status_code=400, detail="sample_rate must be between 0 and 1")
+        request_profiler.sample_rate = config.sample_rate
+    if config.slow_ms is not None:
+        if config.slow_ms < 0:
+            raise HTTPException(status_code=400, detail="slow_ms must not be negative")
+        request_profiler.slow_ms = config.slow_ms
+    return await get_profiling_config()
+
+@app.get("/admin/profiles", dependencies=[Depends(require_admin)])
+async def list_profiles(limit: int = 20, sort: str = "recent"):
+    """Captured profiles without their stacks; `sort=slowest` orders by duration"""
+    profiles = list(request_profiler.profiles)
+    if sort == "slowest":
+        profiles.sort(key=lambda p: p["duration_ms"], reverse=True)
+    else:
+        profiles.reverse()
+    return [{k: v for k, v in p.items() if k != "top"} for p in profiles[:limit]]
+
+@app.get("/admin/profiles/{profile_id}", dependencies=[Depends(require_admin)])
+async def get_profile_detail(profile_id: int):
+    for profile in request_profiler.profiles:
+        if profile["id"] == profile_id:
+            return profile
+    raise HTTPException(status_code=404, detail="Profile not found")
+
+@app.delete("/admin/profiles", dependencies=[Depends(require_admin)])
+async def clear_profiles():
+    request_profiler.profiles.clear()
+    return {"cleared": True}
+
+# Admin: chat retention
+@app.post("/admin/chat/compact", dependencies=[Depends(require_admin)])
+def compact_chats(request: CompactionRequest, db: Session = Depends(get_db)):
+    """Archive idle sessions now instead of waiting for the scheduled `compact-chats` run"""
+    days = request.older_than_days if request.older_than_days is not None else CHAT_RETENTION_DAYS
+    return compact_chat_history(db, older_than_days=days, vacuum=request.vacuum)
+
+# Admin: catalog snapshot
+@app.post("/admin/snapshot/rebuild", dependencies=[Depends(require_admin)])
+def rebuild_catalog_snapshot(db: Session = Depends(get_db)):
+    """Write a fresh snapshot; every worker maps it on its next check"""
+    if not CATALOG_SNAPSHOT_PATH:
+        raise HTTPException(status_code=400, detail="CATALOG_SNAPSHOT_PATH is not set")
+    started = time.perf_counter()
+    result = write_catalog_snapshot(db, CATALOG_SNAPSHOT_PATH)
+    result["seconds"] = round(time.perf_counter() - started, 3)
+    return result
+
+# Admin: similarity index
+@app.post("/admin/similar/rebuild", dependencies=[Depends(require_admin)])
+def rebuild_similar(request: SimilarRebuildRequest, db: Session = Depends(get_db)):
+    """Rebuild neighbor lists, either for the given products only or from scratch"""
+    started = time.perf_counter()
+    if request.product_ids:
+        updated = refresh_similar_products(db, request.product_ids)
+    else:
+        updated = build_similar_products(db)
+    return {"updated_products": updated, "seconds": round(time.perf_counter() - started, 3)}
+
+# Chat admission control
+# Each chat call runs several ILIKE scans and a write transaction, so one
+# client flooding /chat/message would slow search for everyone. Requests are
+# admitted in two steps: a per-user token bucket (CHAT_RATE_PER_MINUTE
+# sustained, CHAT_BURST at once), then a per-worker concurrency limit with a
+# short bounded wait queue. Anything refused gets an immediate 429 with
+# Retry-After. Buckets live in process memory, or in a small SQLite file
+# shared by all workers when RATE_LIMIT_STORE_PATH is set.
+#
+# Admission runs before anything else the endpoint depends on. Buckets are
+# keyed on the token's subject, which needs no database, so a refused request
+# never holds a pooled connection and an admitted one only opens its session
+# once it has a slot.
+CHAT_RATE_PER_MINUTE = float(os.getenv("CHAT_RATE_PER_MINUTE", "30"))
+CHAT_BURST = float(os.getenv("CHAT_BURST", "10"))
+CHAT_MAX_CONCURRENCY = int(os.getenv("CHAT_MAX_CONCURRENCY", "8"))
+CHAT_QUEUE_SIZE = int(os.getenv("CHAT_QUEUE_SIZE", "32"))
+CHAT_QUEUE_TIMEOUT_SECONDS = float(os.getenv("CHAT_QUEUE_TIMEOUT_SECONDS", "2.0"))
+CHAT_BATCH_MAX_MESSAGES = int(os.getenv("CHAT_BATCH_MAX_MESSAGES", "50"))
+RATE_LIMIT_STORE_PATH = os.getenv("RATE_LIMIT_STORE_PATH", "")
+RATE_LIMIT_MAX_KEYS = int(os.getenv("RATE_LIMIT_MAX_KEYS", "100000"))
+RATE_LIMIT_PRUNE_SECONDS = float(os.getenv("RATE_LIMIT_PRUNE_SECONDS", "60"))
+
+class TokenBuckets:
+    """In-process token buckets; least recently seen keys are dropped past max_keys"""
+    
+    blocking = False
+    
+    def __init__(self, rate_per_second: float, burst: float, max_keys: int = RATE_LIMIT_MAX_KEYS):
+        self.rate = rate_per_second
+        self.burst = burst
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()  # key -> (tokens, updated_at)
+        self._lock = threading.Lock()
+    
+    def take(self, key, cost: float = 1.0) -> float:
+        """Spend `cost` tokens; returns 0 if allowed, else seconds until it would be.
+
+        A cost above the burst size is admitted from a full bucket and leaves
+        it in debt, so large batches are slowed down rather than refused forever.
+        """
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated_at = self._buckets.pop(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - updated_at) * self.rate)
+            allowed = tokens >= min(cost, self.burst)
+            if allowed:
+                tokens -= cost
+            self._buckets[key] = (tokens, now)
+            if len(self._buckets) > self.max_keys:
+                # A dropped key just starts over with a full bucket
+                self._buckets.popitem(last=False)
+        return 0.0 if allowed else _refill_wait(tokens, min(cost, self.burst), self.rate)
+
+class SQLiteTokenBuckets:
+    """Token buckets in a SQLite file, so every worker draws from the same bucket.
+
+    Each check is a single upsert; SQLite's write lock makes it atomic across
+    processes. The file is separate from the main database to keep rate
+    limiting off its write lock. Waiting on that lock blocks, so callers on
+    the event loop go through a threadpool. Buckets that have refilled are
+    indistinguishable from missing ones and get deleted every prune_seconds.
+    """
+    
+    blocking = True
+    
+    def __init__(self, path: str, rate_per_second: float, burst: float, prune_seconds: float = RATE_LIMIT_PRUNE_SECONDS):
+        self.path = path
+        self.rate = rate_per_second
+        self.burst = burst
+        self.prune_seconds = prune_seconds
+        self.next_prune = 0.0
+        self._local = threading.local()
+    
+    def _connection(self):
+        import sqlite3
+        
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS rate_buckets (key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated_at REAL NOT NULL)")
+            self._local.conn = conn
+        return conn
+    
+    def take(self, key, cost: float = 1.0) -> float:
+        # Wall clock, since monotonic clocks aren't comparable between processes
+        now = time.time()
+        params = {"key": str(key), "now": now, "rate": self.rate, "burst": self.burst, "cost": cost}
+        conn = self._connection()
+        row = conn.execute(
+            """
+            INSERT INTO rate_buckets (key, tokens, updated_at) VALUES (:key, :burst - :cost, :now)
+            ON CONFLICT (key) DO UPDATE SET
+                tokens = min(:burst, tokens + max(:now - updated_at, 0) * :rate) - :cost,
+                updated_at = :now
+            WHERE min(:burst, tokens + max(:now - updated_at, 0) * :rate) >= min(:cost, :burst)
+            RETURNING tokens
+            """,
+            params
+        ).fetchone()
+        if now >= self.next_prune:
+            self.next_prune = now + self.prune_seconds
+            self.prune(now)
+        if row is not None:
+            return 0.0
+        tokens, updated_at = conn.execute("SELECT tokens, updated_at FROM rate_buckets WHERE key = :key", params).fetchone()
+        return _refill_wait(min(self.burst, tokens + max(now - updated_at, 0) * self.rate), min(cost, self.burst), self.rate)
+    
+    def prune(self, now: Optional[float] = None) -> int:
+        """Delete buckets that are full again; returns how many went"""
+        now = time.time() if now is None else now
+        return self._connection().execute(
+            "DELETE FROM rate_buckets WHERE tokens + (:now - updated_at) * :rate >= :burst",
+            {"now": now, "rate": self.rate, "burst": self.burst}
+        ).rowcount
+
+def _refill_wait(tokens: float, needed: float, rate: float) -> float:
+    return (needed - tokens) / rate if rate > 0 else float("inf")
+
+class ConcurrencyGate:
+    """At most `limit` requests in progress; up to `queue_size` more wait briefly for a slot"""
+    
+    def __init__(self, limit: int, queue_size: int, timeout: float):
+        self.limit = limit
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self.active = 0
+        self.waiting = 0
+        self._semaphore = None
+    
+    async def acquire(self) -> bool:
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.limit)
+        if not self._semaphore.locked():
+            # Returns without suspending. wait_for would acquire in a separate
+            # task, leaving the slot looking free to the rest of a burst
+            await self._semaphore.acquire()
+            self.active += 1
+            return True
+        if self.waiting >= self.queue_size:
+            return False
+        self.waiting += 1
+        try:
+            await asyncio.wait_for(self._semaphore.acquire(), self.timeout)
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            self.waiting -= 1
+        self.active += 1
+        return True
+    
+    def release(self):
+        self.active -= 1
+        self._semaphore.release()
+
+class ChatAdmission:
+    """FastAPI dependency admitting a chat request or answering 429 right away"""
+    
+    def __init__(self):
+        rate = CHAT_RATE_PER_MINUTE / 60.0
+        self.buckets = SQLiteTokenBuckets(RATE_LIMIT_STORE_PATH, rate, CHAT_BURST) if RATE_LIMIT_STORE_PATH else TokenBuckets(rate, CHAT_BURST)
+        self.gate = ConcurrencyGate(CHAT_MAX_CONCURRENCY, CHAT_QUEUE_SIZE, CHAT_QUEUE_TIMEOUT_SECONDS)
+    
+    async def charge(self, username: str, cost: float = 1.0):
+        """Spend rate-limit tokens, raising 429 if the user has run out"""
+        if self.buckets.blocking:
+            retry_after = await run_in_threadpool(self.buckets.take, username, cost)
+        else:
+            retry_after = self.buckets.take(username, cost)
+        if retry_after > 0:
+            metrics_registry.record_admission_rejection("rate_limited")
+            raise self._too_many("Too many chat messages, slow down", retry_after)
+    
+    async def __call__(self, token: str = Depends(oauth2_scheme)):
+        await self.charge(token_subject(token))
+        await self._enter()
+        try:
+            yield
+        finally:
+            self.gate.release()
+    
+    async def batch(self, request: Request, token: str = Depends(oauth2_scheme)):
+        """Like calling the admission itself, but charging one token per message.
+
+        The body was already read and parsed by FastAPI; request.json() hands
+        back that copy. Malformed bodies are charged one token and then
+        rejected by validation.
+        """
+        try:
+            body = await request.json()
+        except ValueError:
+            body = None
+        messages = body.get("messages") if isinstance(body, dict) else None
+        cost = min(len(messages), CHAT_BATCH_MAX_MESSAGES) if isinstance(messages, list) else 1
+        await self.charge(token_subject(token), max(cost, 1))
+        await self._enter()
+        try:
+            yield
+        finally:
+            self.gate.release()
+    
+    async def _enter(self):
+        if not await self.gate.acquire():
+            metrics_registry.record_admission_rejection("overloaded")
+            raise self._too_many("Chat is busy, try again shortly", 1)
+    
+    @staticmethod
+    def _too_many(detail: str, retry_after: float) -> HTTPException:
+        retry = "86400" if retry_after == float("inf") else str(max(1, math.ceil(retry_after)))
+        return HTTPException(status_code=status.HTTP_429_TOO_MANY_REQUESTS, detail=detail, headers={"Retry-After": retry})
+
+chat_admission = ChatAdmission()
 
 # Enhanced Chat endpoint with better intelligence
-@app.post("/chat/message", response_model=ChatResponse)
-async def send_message(
+@app.post("/chat/message", response_model=ChatResponse, dependencies=[Depends(chat_admission)])
+def send_message(
     request: ChatMessageRequest,
     current_user: User = Depends(get_current_user),
     db: Session = Depends(get_db)
 ):
-    # Create or get session
+    # Create or get session; another user's session id counts as unknown
     if request.session_id:
-        session = db.query(ChatSession).filter(ChatSession.id == request.session_id).first()
+        session = db.query(ChatSession).filter(
+            ChatSession.id == request.session_id,
+            ChatSession.user_id == current_user.id
+        ).first()
         if not session:
             session = ChatSession(id=str(uuid.uuid4()), user_id=current_user.id)
             db.add(session)
@@ -739,8 +1813,12 @@ async def send_message(
     )
     db.add(user_message)
     
+    note_request_context(message=request.message[:1000])
+    
     # Process message and generate response
-    response_text, products = process_chat_message(request.message, db)
+    with track_phase("chat"):
+        response_text, products, state = process_chat_message(request.message, db, load_conversation_state(session))
+    save_conversation_state(session, state)
     
     # Save bot response
     bot_message = ChatMessage(
@@ -752,38 +1830,354 @@ async def send_message(
     )
     db.add(bot_message)
     
-    db.commit()
+    with track_phase("commit"):
+        db.commit()
     
-    return ChatResponse(
-        response=response_text,
-        products=[
-            ProductResponse(
-                id=p.id,
-                name=p.name,
-                description=p.description,
-                price=p.price,
-                category=p.category,
-                brand=p.brand,
-                image_url=p.image_url,
-                rating=p.rating,
-                stock=p.stock,
-                features=json.loads(p.features) if p.features else [],
-                tags=json.loads(p.tags) if p.tags else []
-            )
-            for p in products
-        ] if products else None,
-        session_id=session.id
-    )
+    with track_phase("serialize"):
+        return ChatResponse(
+            response=response_text,
+            products=[product_to_response(p) for p in products] if products else None,
+            session_id=session.id
+        )
 
-def process_chat_message(message: str, db: Session):
-    """Enhanced chat message processing with better intelligence"""
+@app.post("/chat/messages:batch", response_model=ChatBatchResponse, dependencies=[Depends(chat_admission.batch)])
+def send_messages_batch(
+    request: ChatBatchRequest,
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    """Process several messages, possibly for different sessions, in one round trip.
+
+    Messages are handled in order, so later messages for a session see the
+    context left by earlier ones. Identical messages in the same context share
+    one product lookup, and everything is persisted in a single transaction.
+    """
+    if not request.messages:
+        raise HTTPException(status_code=400, detail="Batch must contain at least one message")
+    if len(request.messages) > CHAT_BATCH_MAX_MESSAGES:
+        raise HTTPException(status_code=400, detail=f"Batch is limited to {CHAT_BATCH_MAX_MESSAGES} messages")
+    
+    note_request_context(messages=[item.message[:200] for item in request.messages[:20]])
+    
+    # One query for every session the batch refers to; ids owned by other users count as unknown
+    requested_ids = {item.session_id for item in request.messages if item.session_id}
+    sessions = {}
+    if requested_ids:
+        sessions = {s.id: s for s in db.query(ChatSession).filter(
+            ChatSession.id.in_(requested_ids),
+            ChatSession.user_id == current_user.id
+        ).all()}
+    
+    states = {}
+    lookups = {}
+    message_rows = []
+    results = []
+    with track_phase("chat"):
+        for item in request.messages:
+            session = sessions.get(item.session_id) if item.session_id else None
+            if session is None:
+                session = ChatSession(id=str(uuid.uuid4()), user_id=current_user.id)
+                db.add(session)
+                if item.session_id:
+                    # Later messages naming the same unknown id join this new session
+                    sessions[item.session_id] = session
+            
+            state = states[session.id] if session.id in states else load_conversation_state(session)
+            key = (item.message.lower().strip(), state.to_json() if state else None)
+            if key not in lookups:
+                lookups[key] = process_chat_message(item.message, db, state)
+            response_text, products, new_state = lookups[key]
+            states[session.id] = new_state
+            save_conversation_state(session, new_state)
+            
+            message_rows.append({"id": str(uuid.uuid4()), "session_id": session.id, "content": item.message, "sender": "user"})
+            message_rows.append({
+                "id": str(uuid.uuid4()),
+                "session_id": session.id,
+                "content": response_text,
+                "sender": "bot",
+                "products_data": json.dumps([p.id for p in products]) if products else None
+            })
+            results.append((response_text, products, session.id))
+    
+    # Serialize before committing: the commit expires loaded products and
+    # touching them afterwards would reload each one
+    with track_phase("serialize"):
+        serialized = {}
+        responses = []
+        for response_text, products, session_id in results:
+            for p in products:
+                if p.id not in serialized:
+                    serialized[p.id] = product_to_response(p)
+            responses.append(ChatResponse(
+                response=response_text,
+                products=[serialized[p.id] for p in products] if products else None,
+                session_id=session_id
+            ))
+    
+    with track_phase("commit"):
+        db.flush()
+        db.execute(insert(ChatMessage), message_rows)
+        db.commit()
+    
+    return ChatBatchResponse(results=responses)
+
+@app.get("/chat/archive/{session_id}", response_model=ArchivedSession)
+def get_archived_session(
+    session_id: str,
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    """Read a compacted session back from the archive"""
+    record = read_archived_session(db, session_id)
+    if record is None or record["user_id"] != current_user.id:
+        raise HTTPException(status_code=404, detail="Archived session not found")
+    return record
+
+# Sync endpoints run in the threadpool, out of sight of the profilers watching
+# the event loop thread; hand each request's profiling over to that thread.
+# FastAPI calls dependant.call at request time, so wrapping it is enough.
+def _profiled_threadpool_call(call):
+    @wraps(call)
+    def wrapper(*args, **kwargs):
+        run = current_profile_run.get()
+        if run is None or (run.profile is None and run.watch is None):
+            return call(*args, **kwargs)
+        with request_profiler.threadpool_call(run):
+            return call(*args, **kwargs)
+    return wrapper
+
+for api_route in app.routes:
+    if isinstance(api_route, APIRoute) and not asyncio.iscoroutinefunction(api_route.dependant.call):
+        api_route.dependant.call = _profiled_threadpool_call(api_route.dependant.call)
+
+# Conversation context
+# The filters and products behind a session's last answer are kept as a small
+# JSON blob on the chat_sessions row (authoritative, shared across workers)
+# and parsed copies are cached in-process, so follow-ups like "show me cheaper
+# ones" never replay chat_messages.
+CHAT_CONTEXT_CACHE_SIZE = int(os.getenv("CHAT_CONTEXT_CACHE_SIZE", "10000"))
+CHAT_CONTEXT_TTL_SECONDS = float(os.getenv("CHAT_CONTEXT_TTL_SECONDS", "1800"))
+CHAT_CONTEXT_MAX_SHOWN = 24
+
+CHEAPER_CUES = ['cheaper', 'less expensive', 'lower price', 'more affordable', 'budget']
+PRICIER_CUES = ['more expensive', 'pricier', 'higher end', 'high-end', 'more premium']
+MORE_CUES = ['more', 'other', 'another', 'else', 'different']
+REFINEMENT_CUES = CHEAPER_CUES + PRICIER_CUES + MORE_CUES + [
+    'what about', 'how about', 'instead', 'those', 'these', 'them', 'ones', 'anything from', 'any from'
+]
+# Whole words only, so "phones" doesn't read as "ones"
+REFINEMENT_PATTERN = re.compile(r'\b(' + '|'.join(re.escape(cue) for cue in REFINEMENT_CUES) + r')\b')
+MORE_PATTERN = re.compile(r'\b(' + '|'.join(MORE_CUES) + r')\b')
+# Words a follow-up is made of; any other search term means a new question
+# ("show me other wireless chargers") rather than a refinement
+FOLLOW_UP_WORDS = {word for cue in REFINEMENT_CUES for word in cue.split()} | {
+    'anything', 'something', 'any', 'some', 'options', 'option', 'others', 'one', 'like', 'expensive', 'see'
+}
+
+class ConversationState:
+    """Filters and results of a session's last product answer"""
+    __slots__ = ("intent", "category", "brand", "min_price", "max_price", "min_rating", "terms", "shown_ids", "shown_median_price")
+    
+    # Short JSON keys keep the per-session blob small
+    _keys = {
+        "intent": "i", "category": "c", "brand": "b", "min_price": "lo", "max_price": "hi", "min_rating": "r",
+        "terms": "t", "shown_ids": "s", "shown_median_price": "sp"
+    }
+    
+    def __init__(self, intent: str, category=None, brand=None, min_price=None, max_price=None, min_rating=None, terms=None, shown_ids=None, shown_median_price=None):
+        self.intent = intent
+        self.category = category
+        self.brand = brand
+        self.min_price = min_price
+        self.max_price = max_price
+        self.min_rating = min_rating
+        self.terms = terms or []
+        self.shown_ids = shown_ids or []
+        self.shown_median_price = shown_median_price
+    
+    def with_results(self, products: List[Product]) -> "ConversationState":
+        prices = sorted(p.price for p in products if p.price is not None)
+        self.shown_ids = [p.id for p in products][:CHAT_CONTEXT_MAX_SHOWN]
+        self.shown_median_price = prices[len(prices) // 2] if prices else None
+        return self
+    
+    def copy(self) -> "ConversationState":
+        return ConversationState(**{name: getattr(self, name) for name in self.__slots__})
+    
+    def to_json(self) -> str:
+        data = {key: getattr(self, name) for name, key in self._keys.items() if getattr(self, name) not in (None, [])}
+        return json.dumps(data, separators=(",", ":"))
+    
+    @classmethod
+    def from_json(cls, raw: Optional[str]) -> Optional["ConversationState"]:
+        if not raw:
+            return None
+        try:
+            data = json.loads(raw)
+        except ValueError:
+            return None
+        if "i" not in data:
+            return None
+        return cls(**{name: data.get(key) for name, key in cls._keys.items()})
+
+class ConversationCache:
+    """Bounded LRU of parsed session states with a TTL.
+
+    Entries are keyed by the raw JSON they were parsed from, so a session
+    advanced by another worker is detected and re-read from the row.
+    """
+    
+    def __init__(self, max_entries: int = CHAT_CONTEXT_CACHE_SIZE, ttl_seconds: float = CHAT_CONTEXT_TTL_SECONDS):
+        self.max_entries = max_entries
+        self.ttl = ttl_seconds
+        self._entries = OrderedDict()  # session id -> (expires at, raw json, state)
+        self._lock = threading.Lock()
+    
+    def get(self, session_id: str, raw: Optional[str]) -> Optional[ConversationState]:
+        with self._lock:
+            entry = self._entries.get(session_id)
+            if entry is None:
+                return None
+            expires_at, cached_raw, state = entry
+            if expires_at < time.monotonic() or cached_raw != raw:
+                del self._entries[session_id]
+                return None
+            self._entries.move_to_end(session_id)
+            return state
+    
+    def put(self, session_id: str, raw: str, state: ConversationState):
+        with self._lock:
+            self._entries[session_id] = (time.monotonic() + self.ttl, raw, state)
+            self._entries.move_to_end(session_id)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+conversation_cache = ConversationCache()
+
+def load_conversation_state(session: "ChatSession") -> Optional[ConversationState]:
+    state = conversation_cache.get(session.id, session.context)
+    if state is None:
+        state = ConversationState.from_json(session.context)
+        if state is not None:
+            conversation_cache.put(session.id, session.context, state)
+    return state
+
+def save_conversation_state(session: "ChatSession", state: Optional[ConversationState]):
+    session.updated_at = datetime.utcnow()
+    if state is None:
+        return
+    raw = state.to_json()
+    if raw != session.context:
+        session.context = raw
+    conversation_cache.put(session.id, raw, state)
+
+def apply_state_filters(query, state: ConversationState):
+    """Product filters equivalent to the ones that produced `state`"""
+    if state.category:
+        query = query.filter(Product.category.ilike(f"%{state.category}%"))
+    if state.brand:
+        query = query.filter(Product.brand.ilike(f"%{state.brand}%"))
+    if state.min_price is not None:
+        query = query.filter(Product.price >= state.min_price)
+    if state.max_price is not None:
+        query = query.filter(Product.price <= state.max_price)
+    if state.min_rating is not None:
+        query = query.filter(Product.rating >= state.min_rating)
+    for term in state.terms:
+        query = query.filter(
+            Product.name.ilike(f"%{term}%") |
+            Product.description.ilike(f"%{term}%") |
+            tag_matches(f"%{term}%")
+        )
+    return query
+
+def refine_previous_results(message: str, db: Session, state: Optional[ConversationState]):
+    """Answer a follow-up on top of the previous turn's filters.
+
+    Returns (response, products, new state), or None when the message starts
+    a new topic and should go through normal intent matching.
+    """
+    if state is None or not REFINEMENT_PATTERN.search(message):
+        return None
+    category_hint = extract_category_hint(message)
+    if category_hint and category_hint != state.category:
+        return None
+    brand_hint = extract_brand_hint(message)
+    # Plurals and the like of the previous terms ("laptops" after "laptop") are not new
+    if any(
+        term not in FOLLOW_UP_WORDS and term != brand_hint and not any(term.startswith(previous) for previous in state.terms)
+        for term in extract_search_terms(message)
+    ):
+        return None
+    
+    refined = state.copy()
+    if brand_hint:
+        refined.brand = brand_hint
+    price_range = extract_price_range(message)
+    if price_range:
+        refined.min_price, refined.max_price = price_range
+    
+    query = db.query(Product).filter(Product.stock > 0)
+    label = f"{refined.category.lower()} " if refined.category else ""
+    if not price_range and any(cue in message for cue in CHEAPER_CUES) and state.shown_median_price is not None:
+        # Below the typical price shown last time, best rated first
+        refined.max_price = round(state.shown_median_price - 0.01, 2)
+        refined.min_price = None
+        query = apply_state_filters(query, refined).filter(~Product.id.in_(state.shown_ids)).order_by(Product.rating.desc())
+        response = f"Here are some more affordable {label}options:"
+    elif not price_range and any(cue in message for cue in PRICIER_CUES) and state.shown_median_price is not None:
+        refined.min_price = round(state.shown_median_price + 0.01, 2)
+        refined.max_price = None
+        query = apply_state_filters(query, refined).filter(~Product.id.in_(state.shown_ids)).order_by(Product.rating.desc())
+        response = f"Here are some higher-end {label}options:"
+    elif not brand_hint and not price_range and MORE_PATTERN.search(message):
+        # Same filters, skipping what was already shown
+        query = apply_state_filters(query, refined).filter(~Product.id.in_(state.shown_ids)).order_by(Product.rating.desc())
+        response = f"Here are a few more {label}options:"
+    elif brand_hint or price_range:
+        query = apply_state_filters(query, refined).order_by(Product.rating.desc())
+        response = f"Here are the updated {label}results:"
+    else:
+        return None
+    
+    products = query.limit(6).all()
+    if not products:
+        # Keep the previous context so the user can refine it differently
+        return "I couldn't find anything else matching that. Try widening your budget or another brand.", [], state
+    return response, products, refined.with_results(products)
+
+def process_chat_message(message: str, db: Session, state: Optional[ConversationState] = None):
+    """Enhanced chat message processing with better intelligence.
+    
+    Returns (response, products, state) where state is the conversation
+    context to carry into the next turn.
+    """
     message_lower = message.lower()
     
     products = []
     response = ""
+    new_state = state
+    
+    # "More like X" queries
+    anchor = None
+    similarity_phrase = next((phrase for phrase in SIMILARITY_PHRASES if phrase in message_lower), None)
+    if similarity_phrase:
+        anchor = find_similarity_anchor(message_lower.split(similarity_phrase, 1)[1], db)
+    
+    refinement = None if anchor else refine_previous_results(message_lower, db, state)
+    
+    if anchor:
+        products = get_similar_products(db, anchor.id)
+        response = f"Here are some products similar to the {anchor.name}:"
+        new_state = ConversationState("similar", category=anchor.category)
+    
+    # Follow-ups such as "show me cheaper ones" reuse the previous turn's filters
+    elif refinement:
+        response, products, new_state = refinement
     
     # Enhanced product search patterns
-    if any(word in message_lower for word in ['find', 'search', 'show', 'looking for', 'need', 'want', 'get', 'buy']):
+    elif any(word in message_lower for word in ['find', 'search', 'show', 'looking for', 'need', 'want', 'get', 'buy']):
         search_terms = extract_search_terms(message_lower)
         price_range = extract_price_range(message_lower)
         category_hint = extract_category_hint(message_lower)
@@ -806,22 +2200,39 @@ def process_chat_message(message: str, db: Session):
             if price_range[1]:
                 query = query.filter(Product.price <= price_range[1])
         
+        filtered_query = query
+        
         # Apply search terms
         if search_terms:
             for term in search_terms:
                 query = query.filter(
                     Product.name.ilike(f"%{term}%") |
                     Product.description.ilike(f"%{term}%") |
-                    Product.tags.ilike(f"%{term}%")
+                    tag_matches(f"%{term}%")
                 )
         
         # Prioritize in-stock, high-rated products
         query = query.filter(Product.stock > 0).order_by(Product.rating.desc())
         products = query.limit(6).all()
+        terms_matched = bool(products)
+        
+        if SEMANTIC_SEARCH_ENABLED:
+            products = fuse_semantic_results(message_lower, products, filtered_query.filter(Product.stock > 0), 6)
         
         if products:
+            # Semantic-only matches satisfy the filters but not the keyword terms
+            new_state = ConversationState(
+                "search",
+                category=category_hint,
+                brand=brand_hint,
+                min_price=price_range[0] if price_range else None,
+                max_price=price_range[1] if price_range else None,
+                terms=search_terms if terms_matched else []
+            )
             response = f"I found {len(products)} great products that match your search! Here are my top recommendations:"
         else:
+            # Filters that matched nothing would only make follow-ups fail too,
+            # so the previous context stays in place
             response = "I couldn't find any products matching your specific criteria. Let me show you some popular alternatives:"
             # Fallback to popular products
             products = db.query(Product).filter(Product.rating >= 4.5, Product.stock > 0).limit(6).all()
@@ -840,6 +2251,7 @@ def process_chat_message(message: str, db: Session):
             query = query.filter(Product.price <= price_range[1])
         
         products = query.order_by(Product.price.asc()).limit(6).all()
+        new_state = ConversationState("compare", category=category_hint, max_price=price_range[1] if price_range else None)
         response = "Here are some great options at different price points. I can help you compare features and find the best value!"
     
     # Recommendation queries
@@ -852,6 +2264,7 @@ def process_chat_message(message: str, db: Session):
             query = query.filter(Product.category.ilike(f"%{category_hint}%"))
         
         products = query.order_by(Product.rating.desc()).limit(6).all()
+        new_state = ConversationState("recommend", category=category_hint, min_rating=4.5)
         response = "Here are my top recommendations based on customer ratings, reviews, and popularity:"
     
     # Category browsing
@@ -874,11 +2287,13 @@ def process_chat_message(message: str, db: Session):
                     Product.stock > 0
                 ).order_by(Product.rating.desc()).limit(6).all()
                 response = f"Here are some excellent {category.lower()} products from our collection:"
+                new_state = ConversationState("browse", category=category)
                 break
     
     # Default responses
     if not response:
-        if any(word in message_lower for word in ['hello', 'hi', 'hey', 'help', 'start']):
+        # Whole words only: 'hi' must not match "something" or "this"
+        if re.search(r'\b(hello|hi|hey|help|start)\b', message_lower):
             response = """Hello! 👋 I'm your personal shopping assistant. I can help you:
 
 • 🔍 **Search** for specific products
@@ -894,11 +2309,20 @@ Try asking me something like:
 
 What are you looking for today?"""
         else:
-            # Try to extract any product-related terms and show general recommendations
-            products = db.query(Product).filter(Product.rating >= 4.7, Product.stock > 0).limit(6).all()
-            response = "I can help you find the perfect products! Here are some of our most popular items, or you can tell me specifically what you're looking for:"
+            # Descriptions like "something to block noise on flights" match no keyword intent
+            if SEMANTIC_SEARCH_ENABLED:
+                products = semantic_search_products(message_lower, db.query(Product).filter(Product.stock > 0), 6)
+            if products:
+                response = "Here's what I found that matches what you described:"
+            else:
+                # Try to extract any product-related terms and show general recommendations
+                products = db.query(Product).filter(Product.rating >= 4.7, Product.stock > 0).limit(6).all()
+                response = "I can help you find the perfect products! Here are some of our most popular items, or you can tell me specifically what you're looking for:"
     
-    return response, products
+    if new_state is not state and new_state is not None and not refinement:
+        new_state.with_results(products)
+    
+    return response, products, new_state
 
 def extract_search_terms(message: str):
     """Extract relevant search terms from user message"""
@@ -909,7 +2333,8 @@ def extract_search_terms(message: str):
     }
     
     words = re.findall(r'\b\w+\b', message.lower())
-    search_terms = [word for word in words if word not in stop_words and len(word) > 2]
+    # Bare numbers are prices ("under $1000"), handled by extract_price_range
+    search_terms = [word for word in words if word not in stop_words and len(word) > 2 and not word.isdigit()]
     
     return search_terms
 
@@ -958,9 +2383,10 @@ def extract_category_hint(message: str):
         'smart home': 'Smart Home'
     }
     
-    for keyword, category in category_keywords.items():
+    # Longest keywords first so "headphone" wins over "phone"
+    for keyword in sorted(category_keywords, key=len, reverse=True):
         if keyword in message.lower():
-            return category
+            return category_keywords[keyword]
     
     return None
 
@@ -974,6 +2400,1389 @@ def extract_brand_hint(message: str):
     
     return None
 
+# Product similarity
+# Content-based "more like this": TF-IDF over product text plus category,
+# brand and price features. Neighbor lists are computed offline in blocks and
+# stored in product_neighbors, so serving them is a primary-key lookup.
+SIMILAR_TOP_K = int(os.getenv("SIMILAR_TOP_K", "10"))
+SIMILARITY_MAX_FEATURES = int(os.getenv("SIMILARITY_MAX_FEATURES", "512"))
+SIMILARITY_WEIGHTS = {"text": 0.6, "category": 0.2, "brand": 0.1, "price": 0.1}
+
+SIMILARITY_STOP_WORDS = {
+    'and', 'the', 'with', 'for', 'from', 'your', 'our', 'all', 'high', 'quality',
+    'advanced', 'features', 'feature', 'perfect', 'build', 'enthusiasts'
+}
+
+def product_text_tokens(product: Product) -> List[str]:
+    """Tokens describing a product; tags count twice since they are curated"""
+    tags = product.tags
+    text = " ".join([product.name or "", product.description or "", " ".join(product.features), " ".join(tags + tags)])
+    return [
+        word for word in re.findall(r'\b\w+\b', text.lower())
+        if len(word) > 2 and not word.isdigit() and word not in SIMILARITY_STOP_WORDS
+    ]
+
+class SimilarityIndex:
+    """In-memory product vectors and top-k neighbor arrays.
+
+    The vocabulary and IDF weights are fixed at full-build time and stored in
+    similarity_terms, so any process can restore the index from them plus the
+    stored neighbor lists. Incremental updates re-vectorize changed products
+    against that vocabulary and patch only the neighbor lists that change.
+    """
+    
+    def __init__(self, top_k: int = SIMILAR_TOP_K, max_features: int = SIMILARITY_MAX_FEATURES):
+        self.top_k = top_k
+        self.max_features = max_features
+        self.vocabulary = {}
+        self.idf = None
+        self.row_of = {}  # product id -> row
+        self.product_ids = None
+        self.vectors = None  # (n, vocabulary) float32, rows L2-normalized
+        self.category_codes = None
+        self.brand_codes = None
+        self.log_price = None
+        self.neighbor_ids = None  # (n, k) int64 product ids, -1 padded
+        self.neighbor_scores = None  # (n, k) float32
+        self._categories = {}
+        self._brands = {}
+    
+    def fit(self, products: List["SimilarityProduct"]):
+        import numpy as np
+        
+        tokens = [product_text_tokens(p) for p in products]
+        document_frequency = Counter()
+        for product_tokens in tokens:
+            document_frequency.update(set(product_tokens))
+        terms = [term for term, _ in document_frequency.most_common(self.max_features)]
+        self.vocabulary = {term: i for i, term in enumerate(terms)}
+        n = max(len(products), 1)
+        self.idf = np.array([np.log((1 + n) / (1 + document_frequency[t])) + 1 for t in terms], dtype=np.float32)
+        
+        self._set_products(products, tokens)
+        self._compute_rows(np.arange(len(products)))
+        return self
+    
+    @classmethod
+    def restore(cls, products: List["SimilarityProduct"], terms: List[str], idf: List[float], neighbors) -> "SimilarityIndex":
+        """Rebuild from a stored vocabulary and (product_id, rank, neighbor_id, score) rows without rescoring"""
+        import numpy as np
+        
+        index = cls()
+        index.vocabulary = {term: i for i, term in enumerate(terms)}
+        index.idf = np.array(idf, dtype=np.float32)
+        index._set_products(products, [product_text_tokens(p) for p in products])
+        
+        k = index._k()
+        index.neighbor_ids = np.full((len(products), k), -1, dtype=np.int64)
+        index.neighbor_scores = np.full((len(products), k), -np.inf, dtype=np.float32)
+        if neighbors and k:
+            product_ids, ranks, neighbor_ids, scores = (np.array(column) for column in zip(*neighbors))
+            # Rows of products that no longer exist, or past the current k, are dropped
+            rows = np.searchsorted(index.product_ids, product_ids).clip(max=len(index.product_ids) - 1)
+            keep = (index.product_ids[rows] == product_ids) & (ranks < k)
+            index.neighbor_ids[rows[keep], ranks[keep]] = neighbor_ids[keep]
+            index.neighbor_scores[rows[keep], ranks[keep]] = scores[keep]
+        return index
+    
+    def _set_products(self, products: List["SimilarityProduct"], tokens: List[List[str]]):
+        import numpy as np
+        
+        self.product_ids = np.array([p.id for p in products], dtype=np.int64)
+        self.row_of = {p.id: row for row, p in enumerate(products)}
+        self.vectors = self._vectorize(tokens)
+        self.category_codes = np.array([self._code(self._categories, p.category) for p in products], dtype=np.int32)
+        self.brand_codes = np.array([self._code(self._brands, p.brand) for p in products], dtype=np.int32)
+        self.log_price = np.log1p(np.array([p.price or 0.0 for p in products], dtype=np.float32))
+    
+    def update(self, products: List["SimilarityProduct"]) -> List[int]:
+        """Apply changed or new products; return ids whose neighbor lists changed"""
+        import numpy as np
+        
+        new_products = [p for p in products if p.id not in self.row_of]
+        if new_products:
+            count = len(new_products)
+            start = len(self.product_ids)
+            self.product_ids = np.concatenate([self.product_ids, [p.id for p in new_products]])
+            self.vectors = np.vstack([self.vectors, np.zeros((count, self.vectors.shape[1]), dtype=np.float32)])
+            self.category_codes = np.concatenate([self.category_codes, np.zeros(count, dtype=np.int32)])
+            self.brand_codes = np.concatenate([self.brand_codes, np.zeros(count, dtype=np.int32)])
+            self.log_price = np.concatenate([self.log_price, np.zeros(count, dtype=np.float32)])
+            self.neighbor_ids = np.vstack([self.neighbor_ids, np.full((count, self.neighbor_ids.shape[1]), -1, dtype=np.int64)])
+            self.neighbor_scores = np.vstack([self.neighbor_scores, np.full((count, self.neighbor_scores.shape[1]), -np.inf, dtype=np.float32)])
+            for offset, p in enumerate(new_products):
+                self.row_of[p.id] = start + offset
+        
+        changed_rows = np.array([self.row_of[p.id] for p in products], dtype=np.int64)
+        self.vectors[changed_rows] = self._vectorize([product_text_tokens(p) for p in products])
+        for row, p in zip(changed_rows, products):
+            self.category_codes[row] = self._code(self._categories, p.category)
+            self.brand_codes[row] = self._code(self._brands, p.brand)
+            self.log_price[row] = np.log1p(p.price or 0.0)
+        
+        if len(products) * 10 > len(self.product_ids) or self.neighbor_ids.shape[1] < self._k():
+            # Large batches (or a catalog that outgrew its k) are cheaper to redo wholesale
+            self._compute_rows(np.arange(len(self.product_ids)))
+            return self.product_ids.tolist()
+        
+        before_ids = self.neighbor_ids.copy()
+        changed_ids = self.product_ids[changed_rows]
+        # Rows that list a changed product hold stale scores: recompute them fully
+        stale = np.isin(self.neighbor_ids, changed_ids).any(axis=1)
+        stale[changed_rows] = True
+        self._compute_rows(np.flatnonzero(stale))
+        
+        # Every other row only needs to consider the changed products as new candidates
+        others = np.flatnonzero(~stale)
+        if len(others):
+            k = self.neighbor_ids.shape[1]
+            candidate_scores = self._scores(changed_rows, others).T  # (others, changed)
+            merged_scores = np.hstack([self.neighbor_scores[others], candidate_scores])
+            merged_ids = np.hstack([self.neighbor_ids[others], np.broadcast_to(changed_ids, candidate_scores.shape)])
+            order = np.argsort(-merged_scores, axis=1, kind="stable")[:, :k]
+            self.neighbor_scores[others] = np.take_along_axis(merged_scores, order, axis=1)
+            self.neighbor_ids[others] = np.take_along_axis(merged_ids, order, axis=1)
+        
+        moved = (self.neighbor_ids != before_ids).any(axis=1)
+        moved[changed_rows] = True
+        return self.product_ids[moved].tolist()
+    
+    def neighbors(self, product_id: int) -> List[tuple]:
+        row = self.row_of.get(product_id)
+        if row is None:
+            return []
+        return [
+            (int(neighbor), float(score))
+            for neighbor, score in zip(self.neighbor_ids[row], self.neighbor_scores[row])
+            if neighbor >= 0
+        ]
+    
+    def _k(self) -> int:
+        return max(0, min(self.top_k, len(self.product_ids) - 1))
+    
+    @staticmethod
+    def _code(codes: dict, value) -> int:
+        return codes.setdefault(value, len(codes))
+    
+    def _vectorize(self, tokens: List[List[str]]):
+        import numpy as np
+        
+        vectors = np.zeros((len(tokens), len(self.vocabulary)), dtype=np.float32)
+        for row, product_tokens in enumerate(tokens):
+            counts = Counter(t for t in product_tokens if t in self.vocabulary)
+            if counts:
+                columns = np.fromiter((self.vocabulary[t] for t in counts), dtype=np.int64, count=len(counts))
+                vectors[row, columns] = 1 + np.log(np.fromiter(counts.values(), dtype=np.float32, count=len(counts)))
+        vectors *= self.idf
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        np.divide(vectors, norms, out=vectors, where=norms > 0)
+        return vectors
+    
+    def _scores(self, rows, columns=None):
+        """Blended similarity of `rows` against `columns` (default: every product)"""
+        import numpy as np
+        
+        if columns is None:
+            columns = slice(None)
+        weights = SIMILARITY_WEIGHTS
+        scores = weights["text"] * (self.vectors[rows] @ self.vectors[columns].T)
+        scores += weights["category"] * (self.category_codes[rows, None] == self.category_codes[None, columns])
+        scores += weights["brand"] * (self.brand_codes[rows, None] == self.brand_codes[None, columns])
+        scores += weights["price"] * np.exp(-np.abs(self.log_price[rows, None] - self.log_price[None, columns]))
+        return scores
+    
+    def _compute_rows(self, rows):
+        """Recompute top-k neighbors for `rows`, a block at a time to bound memory"""
+        import numpy as np
+        
+        n = len(self.product_ids)
+        k = self._k()
+        if self.neighbor_ids is None or self.neighbor_ids.shape[1] != k:
+            self.neighbor_ids = np.full((n, k), -1, dtype=np.int64)
+            self.neighbor_scores = np.full((n, k), -np.inf, dtype=np.float32)
+        if k == 0 or len(rows) == 0:
+            return
+        
+        # Keep each (block, n) score matrix around 32 MB
+        block_size = max(1, min(1024, 8_000_000 // n))
+        for start in range(0, len(rows), block_size):
+            block = rows[start:start + block_size]
+            scores = self._scores(block)
+            scores[np.arange(len(block)), block] = -np.inf  # a product is not its own neighbor
+            top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+            top_scores = np.take_along_axis(scores, top, axis=1)
+            order = np.argsort(-top_scores, axis=1, kind="stable")
+            self.neighbor_ids[block] = self.product_ids[np.take_along_axis(top, order, axis=1)]
+            self.neighbor_scores[block] = np.take_along_axis(top_scores, order, axis=1)
+
+# Built lazily per process; only needed to (re)compute neighbor lists
+similarity_index: Optional[SimilarityIndex] = None
+similarity_lock = threading.Lock()
+# Products repriced through the change log since this process last refreshed
+similarity_pending: set = set()
+
+def save_product_neighbors(db: Session, index: SimilarityIndex, product_ids: List[int], batch_size: int = 5000):
+    if not product_ids:
+        return
+    for start in range(0, len(product_ids), batch_size):
+        chunk = product_ids[start:start + batch_size]
+        db.query(ProductNeighbor).filter(ProductNeighbor.product_id.in_(chunk)).delete(synchronize_session=False)
+        rows = [
+            {"product_id": product_id, "rank": rank, "neighbor_id": neighbor_id, "score": score}
+            for product_id in chunk
+            for rank, (neighbor_id, score) in enumerate(index.neighbors(product_id))
+        ]
+        if rows:
+            db.execute(insert(ProductNeighbor), rows)
+    db.commit()
+
+def save_similarity_terms(db: Session, index: SimilarityIndex):
+    inverse = sorted(index.vocabulary, key=index.vocabulary.get)
+    db.query(SimilarityTerm).delete(synchronize_session=False)
+    if inverse:
+        db.execute(insert(SimilarityTerm), [
+            {"position": i, "term": term, "idf": float(idf)} for i, (term, idf) in enumerate(zip(inverse, index.idf))
+        ])
+
+# The columns product_text_tokens and SimilarityIndex read, without building
+# ORM objects: for a full catalog that is most of the load time
+SimilarityProduct = namedtuple("SimilarityProduct", "id name description category brand price features tags")
+
+def load_similarity_products(db: Session, product_ids: Optional[List[int]] = None) -> List[SimilarityProduct]:
+    """Products ordered by id, all of them or just `product_ids`"""
+    products = select(Product.id, Product.name, Product.description, Product.category, Product.brand, Product.price)
+    features = select(ProductFeature.product_id, ProductFeature.text).order_by(ProductFeature.product_id, ProductFeature.position)
+    tags = select(ProductTag.product_id, Tag.name).join(Tag, Tag.id == ProductTag.tag_id).order_by(ProductTag.product_id, ProductTag.position)
+    if product_ids is not None:
+        products = products.where(Product.id.in_(product_ids))
+        features = features.where(ProductFeature.product_id.in_(product_ids))
+        tags = tags.where(ProductTag.product_id.in_(product_ids))
+    
+    features_of, tags_of = defaultdict(list), defaultdict(list)
+    for product_id, feature in db.execute(features):
+        features_of[product_id].append(feature)
+    for product_id, tag in db.execute(tags):
+        tags_of[product_id].append(tag)
+    return [
+        SimilarityProduct(*row, features_of.get(row[0], []), tags_of.get(row[0], []))
+        for row in db.execute(products.order_by(Product.id))
+    ]
+
+def load_similarity_index(db: Session) -> Optional[SimilarityIndex]:
+    """Restore the index a full build stored, or None if there was none"""
+    terms = db.execute(select(SimilarityTerm.term, SimilarityTerm.idf).order_by(SimilarityTerm.position)).all()
+    if not terms:
+        return None
+    # One row per (product, rank): read them on the raw cursor, skipping SQLAlchemy's row objects
+    neighbors = db.connection().connection.dbapi_connection.execute(
+        "SELECT product_id, rank, neighbor_id, score FROM product_neighbors"
+    ).fetchall()
+    products = load_similarity_products(db)
+    return SimilarityIndex.restore(products, [t.term for t in terms], [t.idf for t in terms], neighbors)
+
+def build_similar_products(db: Session) -> int:
+    """Full rebuild: refit the vocabulary and recompute every neighbor list"""
+    global similarity_index
+    with similarity_lock:
+        products = load_similarity_products(db)
+        index = SimilarityIndex().fit(products)
+        db.query(ProductNeighbor).delete(synchronize_session=False)
+        save_similarity_terms(db, index)
+        save_product_neighbors(db, index, index.product_ids.tolist())
+        similarity_index = index
+        return len(products)
+
+def refresh_similar_products(db: Session, product_ids: List[int], build_if_missing: bool = True) -> int:
+    """Incremental rebuild after the given products were added or changed.
+
+    A process that has not built the index itself restores it from the
+    stored vocabulary and neighbor lists; only a database that never had a
+    full build gets one here, and only if `build_if_missing`.
+    """
+    global similarity_index
+    with similarity_lock:
+        index = similarity_index or load_similarity_index(db)
+        if index is None:
+            if not build_if_missing:
+                return 0
+            index = SimilarityIndex().fit(load_similarity_products(db))
+            save_similarity_terms(db, index)
+            changed = index.product_ids.tolist()
+        else:
+            # Repricings other workers already stored still have to reach our copy of the lists
+            product_ids = set(product_ids) | similarity_pending
+            similarity_pending.clear()
+            products = load_similarity_products(db, list(product_ids))
+            changed = index.update(products) if products else []
+        save_product_neighbors(db, index, changed)
+        similarity_index = index
+        return len(changed)
+
+def refresh_repriced_neighbors(product_ids: List[int]):
+    """Background task after price updates; a no-op until neighbor lists were built once"""
+    db = SessionLocal()
+    try:
+        refresh_similar_products(db, product_ids, build_if_missing=False)
+    finally:
+        db.close()
+
+def get_similar_products(db: Session, product_id: int, limit: int = 6) -> List[Product]:
+    """In-stock neighbors of a product; same-category best sellers if none are precomputed"""
+    products = db.query(Product).join(
+        ProductNeighbor, ProductNeighbor.neighbor_id == Product.id
+    ).filter(
+        ProductNeighbor.product_id == product_id,
+        Product.stock > 0
+    ).order_by(ProductNeighbor.rank).limit(limit).all()
+    
+    if not products:
+        anchor = db.get(Product, product_id)
+        if anchor is not None:
+            products = db.query(Product).filter(
+                Product.category == anchor.category,
+                Product.id != product_id,
+                Product.stock > 0
+            ).order_by(Product.rating.desc()).limit(limit).all()
+    return products
+
+# Only explicit phrasing counts: "like the" or a bare "alternative" also show
+# up in ordinary requests ("I would like the best laptop")
+SIMILARITY_PHRASES = ('similar to', 'more like', 'alternatives to', 'alternative to')
+
+def find_similarity_anchor(text: str, db: Session) -> Optional[Product]:
+    """Product named in the text after a "similar to ..." phrase; every term must match"""
+    filler = {'this', 'that', 'one', 'products', 'items', 'other', 'others', 'things'}
+    terms = [term for term in extract_search_terms(text) if term not in filler]
+    if not terms:
+        return None
+    query = db.query(Product)
+    for term in terms:
+        query = query.filter(Product.name.ilike(f"%{term}%"))
+    return query.order_by(Product.rating.desc()).first()
+
+# Semantic retrieval
+# Products are embedded offline as signed feature-hashed vectors of words and
+# character trigrams (CPU-only, no model download) and stored as a float32
+# .npy matrix that workers memory-map. A small query-expansion lexicon maps
+# everyday phrasing ("flights", "quiet") onto catalog vocabulary.
+SEMANTIC_SEARCH_ENABLED = os.getenv("SEMANTIC_SEARCH_ENABLED", "false").lower() in ("1", "true", "yes")
+EMBEDDING_INDEX_PATH = os.getenv("EMBEDDING_INDEX_PATH", "./product_embeddings.npy")
+EMBEDDING_DIM = int(os.getenv("EMBEDDING_DIM", "256"))
+SEMANTIC_CANDIDATES = int(os.getenv("SEMANTIC_CANDIDATES", "200"))
+SEMANTIC_MIN_SCORE = float(os.getenv("SEMANTIC_MIN_SCORE", "0.2"))
+
+SEMANTIC_EXPANSIONS = {
+    'flight': ['travel'], 'flights': ['travel'], 'plane': ['travel'], 'trip': ['travel'],
+    'commute': ['travel', 'portable'], 'block': ['canceling'], 'quiet': ['noise', 'canceling'],
+    'silence': ['noise', 'canceling'], 'music': ['audio', 'headphones', 'speakers'],
+    'listen': ['audio', 'headphones'], 'photos': ['camera', 'photography'],
+    'pictures': ['camera', 'photography'], 'filming': ['video', 'camera'],
+    'running': ['fitness', 'tracker'], 'workout': ['fitness'], 'sleep': ['health', 'sleep'],
+    'office': ['business', 'laptop'], 'work': ['business', 'laptop'], 'play': ['gaming'],
+    'games': ['gaming', 'console'], 'kids': ['family'], 'cheap': ['affordable'],
+    'calls': ['smartphone', 'video-calls'], 'phone': ['smartphone'], 'voice': ['voice-control', 'alexa'],
+    'home': ['smart-home', 'hub'], 'portable': ['portable', 'compact'],
+}
+
+def _hashed_features(tokens: List[str]):
+    """(bucket, signed weight) pairs for words and their character trigrams"""
+    for token in tokens:
+        digest = zlib.crc32(token.encode())
+        yield digest % EMBEDDING_DIM, (1.0 if digest & 0x80000000 else -1.0)
+        padded = f"#{token}#"
+        for i in range(len(padded) - 2):
+            digest = zlib.crc32(padded[i:i + 3].encode())
+            yield digest % EMBEDDING_DIM, (0.5 if digest & 0x80000000 else -0.5)
+
+def embed_tokens(tokens: List[str]):
+    import numpy as np
+    
+    vector = np.zeros(EMBEDDING_DIM, dtype=np.float32)
+    for bucket, weight in _hashed_features(tokens):
+        vector[bucket] += weight
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm > 0 else vector
+
+def query_tokens(text: str) -> List[str]:
+    tokens = extract_search_terms(text)
+    expanded = list(tokens)
+    for token in tokens:
+        expanded.extend(SEMANTIC_EXPANSIONS.get(token, []))
+    return expanded
+
+class EmbeddingIndex:
+    """Memory-mapped product embeddings searched by brute-force dot product"""
+    
+    def __init__(self, product_ids, vectors, mtime: float):
+        self.product_ids = product_ids
+        self.vectors = vectors
+        self.mtime = mtime
+    
+    @staticmethod
+    def ids_path(path: str) -> str:
+        return path[:-len(".npy")] + ".ids.npy" if path.endswith(".npy") else path + ".ids.npy"
+    
+    @classmethod
+    def load(cls, path: str = EMBEDDING_INDEX_PATH) -> Optional["EmbeddingIndex"]:
+        import numpy as np
+        
+        try:
+            mtime = os.stat(path).st_mtime
+            vectors = np.load(path, mmap_mode="r")
+            product_ids = np.load(cls.ids_path(path), mmap_mode="r")
+        except (FileNotFoundError, ValueError):
+            return None
+        if vectors.shape != (len(product_ids), EMBEDDING_DIM):
+            # Caught mid-rebuild or built with another EMBEDDING_DIM
+            return None
+        return cls(product_ids, vectors, mtime)
+    
+    def search(self, text: str, top_k: int = SEMANTIC_CANDIDATES, min_score: float = SEMANTIC_MIN_SCORE) -> List[tuple]:
+        import numpy as np
+        
+        tokens = query_tokens(text)
+        if not tokens or len(self.product_ids) == 0:
+            return []
+        scores = self.vectors @ embed_tokens(tokens)
+        top_k = min(top_k, len(scores))
+        top = np.argpartition(-scores, top_k - 1)[:top_k]
+        top = top[np.argsort(-scores[top], kind="stable")]
+        # Hashed vectors leave a floor of incidental overlap; cut relative to the best hit too
+        cutoff = max(min_score, float(scores[top[0]]) * 0.5)
+        return [(int(self.product_ids[i]), float(scores[i])) for i in top if scores[i] >= cutoff]
+
+embedding_index: Optional[EmbeddingIndex] = None
+
+def get_embedding_index() -> Optional[EmbeddingIndex]:
+    """Current index, re-mapped when the file on disk has been rebuilt"""
+    global embedding_index
+    try:
+        mtime = os.stat(EMBEDDING_INDEX_PATH).st_mtime
+    except FileNotFoundError:
+        return None
+    if embedding_index is None or embedding_index.mtime != mtime:
+        embedding_index = EmbeddingIndex.load(EMBEDDING_INDEX_PATH)
+    return embedding_index
+
+def build_embedding_index(db: Session, path: str = EMBEDDING_INDEX_PATH, batch_size: int = 10000) -> int:
+    """Embed every product into a new file, then atomically swap it into place"""
+    import numpy as np
+    
+    count = db.query(Product).count()
+    vectors_tmp = f"{path}.tmp.npy"
+    ids_tmp = f"{EmbeddingIndex.ids_path(path)}.tmp.npy"
+    vectors = np.lib.format.open_memmap(vectors_tmp, mode="w+", dtype=np.float32, shape=(count, EMBEDDING_DIM))
+    product_ids = np.zeros(count, dtype=np.int64)
+    
+    row = 0
+    last_id = 0
+    while row < count:
+        batch = db.query(Product).filter(Product.id > last_id).order_by(Product.id).limit(batch_size).all()
+        if not batch:
+            break
+        for p in batch[:count - row]:
+            product_ids[row] = p.id
+            vectors[row] = embed_tokens(product_text_tokens(p))
+            row += 1
+        last_id = batch[-1].id
+        db.expunge_all()
+    
+    vectors.flush()
+    del vectors
+    np.save(ids_tmp, product_ids[:row])
+    # Ids first: a reader pairing new ids with old vectors fails the shape check and retries later
+    os.replace(ids_tmp, EmbeddingIndex.ids_path(path))
+    os.replace(vectors_tmp, path)
+    return row
+
+def reciprocal_rank_fusion(*rankings: List[int], k: int = 60) -> List[int]:
+    """Merge ranked id lists; items ranked well in several lists rise to the top"""
+    scores = {}
+    for ranking in rankings:
+        for rank, item in enumerate(ranking):
+            scores[item] = scores.get(item, 0.0) + 1.0 / (k + rank + 1)
+    return sorted(scores, key=scores.get, reverse=True)
+
+def semantic_search_products(text: str, base_query, limit: int, allowed: Optional[Callable[[int], bool]] = None) -> List[Product]:
+    """Semantic hits that also satisfy `base_query`'s filters (and `allowed`, if given), best first"""
+    index = get_embedding_index()
+    if index is None:
+        return []
+    with track_phase("semantic"):
+        hits = index.search(text, top_k=max(SEMANTIC_CANDIDATES, limit))
+    if allowed is not None:
+        hits = [hit for hit in hits if allowed(hit[0])]
+    if not hits:
+        return []
+    by_id = {p.id: p for p in base_query.filter(Product.id.in_([product_id for product_id, _ in hits])).all()}
+    return [by_id[product_id] for product_id, _ in hits if product_id in by_id][:limit]
+
+def fuse_semantic_results(text: str, keyword_products: List[Product], base_query, limit: int, allowed: Optional[Callable[[int], bool]] = None) -> List[Product]:
+    semantic_products = semantic_search_products(text, base_query, limit, allowed)
+    if not semantic_products:
+        return keyword_products[:limit]
+    by_id = {p.id: p for p in semantic_products}
+    by_id.update((p.id, p) for p in keyword_products)
+    fused = reciprocal_rank_fusion([p.id for p in keyword_products], [p.id for p in semantic_products])
+    return [by_id[product_id] for product_id in fused[:limit]]
+
+# Catalog filter index
+# Structured search filters are answered from memory. Each category, brand
+# and tag value gets a bitmap (one bool per product), so "tags: wireless AND
+# noise-canceling, brand in (Sony, Bose)" is a couple of bitwise ops over
+# NumPy arrays instead of joins, and combining filters costs no more than a
+# single one. Price, rating and stock are plain column arrays compared in bulk.
+FILTER_IN_CLAUSE_MAX = 900
+FILTER_PROBE_LIMIT = 1000
+
+class _RankKeys:
+    """Read-only sequence of rank keys for `rows`, computed on access.
+
+    bisect only takes key= from Python 3.10, and building a key tuple for every
+    row up front would cost more than the incremental update saves.
+    """
+    
+    def __init__(self, index: "FilterIndex", rows):
+        self.index = index
+        self.rows = rows
+    
+    def __len__(self) -> int:
+        return len(self.rows)
+    
+    def __getitem__(self, position: int):
+        return self.index._rank_key(self.rows[position])
+
+class FilterIndex:
+    """Column arrays and per-value bitmaps over the whole catalog.
+
+    Row i describes product_ids[i]; ids are ascending so lookups are binary
+    searches. `by_rank` lists rows in the search endpoint's default order
+    (rating, then stock, descending), which lets a mask be paginated without
+    sorting at query time.
+
+    Per-value counters (totals, in-stock counts, category price and rating
+    sums) back the facet and catalog-stats endpoints. Product changes are
+    applied with `with_changes`, which returns an updated copy so requests
+    already holding this index keep a consistent view.
+    """
+    DIMENSIONS = ("category", "brand", "tag")
+    # Above this many re-ranked rows a full sort beats moving rows one by one
+    RERANK_INCREMENTAL_MAX = 1000
+    
+    def __init__(self):
+        import numpy as np
+        
+        self.product_ids = np.zeros(0, dtype=np.int64)
+        self.price = np.zeros(0, dtype=np.float64)
+        self.rating = np.zeros(0, dtype=np.float64)
+        self.stock = np.zeros(0, dtype=np.int64)
+        self.by_rank = np.zeros(0, dtype=np.int64)
+        # dimension -> normalized values, indexed by code
+        self.keys = {dimension: [] for dimension in self.DIMENSIONS}
+        # dimension -> normalized value -> bool array
+        self.bitmaps = {dimension: {} for dimension in self.DIMENSIONS}
+        # normalized value -> value as stored, for labels
+        self.labels = {dimension: {} for dimension in self.DIMENSIONS}
+        # Row -> code for the single-valued dimensions; tags are a CSR list per row
+        self.codes = {"category": np.zeros(0, dtype=np.int64), "brand": np.zeros(0, dtype=np.int64)}
+        self.row_tag_offsets = np.zeros(1, dtype=np.int64)
+        self.row_tag_codes = np.zeros(0, dtype=np.int64)
+        # dimension -> count per code
+        self.totals = {dimension: np.zeros(0, dtype=np.int64) for dimension in self.DIMENSIONS}
+        self.in_stock_counts = {dimension: np.zeros(0, dtype=np.int64) for dimension in self.DIMENSIONS}
+        # Per category code
+        self.price_sums = np.zeros(0, dtype=np.float64)
+        self.rating_sums = np.zeros(0, dtype=np.float64)
+        # Set when the arrays are views of a mapped snapshot file
+        self.snapshot_version: Optional[int] = None
+        self.snapshot_id = None
+    
+    @classmethod
+    def build(cls, db: Session) -> "FilterIndex":
+        import numpy as np
+        
+        index = cls()
+        conn = db.connection()
+        rows = conn.execute(
+            select(Product.id, Product.category, Product.brand, Product.price, Product.rating, Product.stock).order_by(Product.id)
+        ).all()
+        ids, categories, brands, prices, ratings, stocks = zip(*rows) if rows else ((),) * 6
+        # Plain tuples: NumPy probes Row objects element by element
+        index.product_ids = np.array(ids, dtype=np.int64)
+        index.price = np.array([price or 0.0 for price in prices], dtype=np.float64)
+        index.rating = np.array([rating or 0.0 for rating in ratings], dtype=np.float64)
+        index.stock = np.array([stock or 0 for stock in stocks], dtype=np.int64)
+        index._rank_all()
+        in_stock = index.stock > 0
+        
+        for dimension, column in (("category", categories), ("brand", brands)):
+            raw = np.array([value or "" for value in column], dtype=object)
+            keys, first, codes = np.unique(np.array([normalize_tag(value) for value in raw], dtype=object), return_index=True, return_inverse=True)
+            index.keys[dimension] = keys.tolist()
+            index.codes[dimension] = codes.astype(np.int64)
+            for code, key in enumerate(index.keys[dimension]):
+                index.bitmaps[dimension][key] = codes == code
+                # "Audio" and "audio" share one entry, labelled as first stored
+                index.labels[dimension][key] = raw[first[code]]
+            index.totals[dimension] = np.bincount(codes, minlength=len(keys)).astype(np.int64)
+            index.in_stock_counts[dimension] = np.bincount(codes[in_stock], minlength=len(keys)).astype(np.int64)
+        
+        category_codes = index.codes["category"]
+        count = len(index.keys["category"])
+        index.price_sums = np.bincount(category_codes, weights=index.price, minlength=count)
+        index.rating_sums = np.bincount(category_codes, weights=index.rating, minlength=count)
+        
+        tag_names = dict(conn.execute(select(Tag.id, Tag.name)).all())
+        links = conn.execute(select(ProductTag.product_id, ProductTag.tag_id)).all()
+        links = np.fromiter(itertools.chain.from_iterable(links), dtype=np.int64, count=2 * len(links)).reshape(-1, 2)
+        tag_keys = sorted({normalize_tag(tag_names[tag_id]) for tag_id in np.unique(links[:, 1]).tolist()})
+        code_of_key = {key: code for code, key in enumerate(tag_keys)}
+        code_of_tag = {tag_id: code_of_key[normalize_tag(name)] for tag_id, name in tag_names.items() if normalize_tag(name) in code_of_key}
+        link_rows = np.searchsorted(index.product_ids, links[:, 0])
+        link_codes = np.array([code_of_tag[tag_id] for tag_id in links[:, 1].tolist()], dtype=np.int64)
+        
+        by_row = np.lexsort((link_codes, link_rows))
+        index.row_tag_codes = link_codes[by_row]
+        index.row_tag_offsets = np.searchsorted(link_rows[by_row], np.arange(len(index.product_ids) + 1))
+        index.keys["tag"] = tag_keys
+        for tag_id, name in tag_names.items():
+            key = normalize_tag(name)
+            if key in code_of_key:
+                index.labels["tag"].setdefault(key, name)
+        by_code = np.argsort(link_codes, kind="stable")
+        starts = np.searchsorted(link_codes[by_code], np.arange(len(tag_keys)))
+        for key, tag_rows in zip(tag_keys, np.split(link_rows[by_code], starts[1:])):
+            bitmap = np.zeros(len(index.product_ids), dtype=bool)
+            bitmap[tag_rows] = True
+            index.bitmaps["tag"][key] = bitmap
+        index.totals["tag"] = np.array([int(index.bitmaps["tag"][key].sum()) for key in tag_keys], dtype=np.int64)
+        index.in_stock_counts["tag"] = np.array([int((index.bitmaps["tag"][key] & in_stock).sum()) for key in tag_keys], dtype=np.int64)
+        return index
+    
+    def _rank_key(self, row: int):
+        return (-self.rating[row], -self.stock[row], self.product_ids[row])
+    
+    def _rank_all(self):
+        import numpy as np
+        
+        self.by_rank = np.lexsort((self.product_ids, -self.stock, -self.rating))
+    
+    def with_changes(self, changes) -> Optional["FilterIndex"]:
+        """Copy of the index with product_changes rows (new price/rating/stock values) applied.
+
+        Returns None when a change names a product the index has never seen;
+        the caller rebuilds instead.
+        """
+        import copy
+        import numpy as np
+        
+        latest = {change.product_id: change for change in changes}
+        rows = self.rows_of(list(latest))
+        if len(rows) != len(latest):
+            return None
+        updated = copy.copy(self)
+        if not len(rows):
+            return updated
+        new = list(latest.values())
+        new_price = np.array([change.price for change in new], dtype=np.float64)
+        new_rating = np.array([change.rating for change in new], dtype=np.float64)
+        new_stock = np.array([change.stock for change in new], dtype=np.int64)
+        
+        category_codes = self.codes["category"][rows]
+        updated.price_sums = self.price_sums.copy()
+        np.add.at(updated.price_sums, category_codes, new_price - self.price[rows])
+        updated.rating_sums = self.rating_sums.copy()
+        np.add.at(updated.rating_sums, category_codes, new_rating - self.rating[rows])
+        
+        delta = (new_stock > 0).astype(np.int64) - (self.stock[rows] > 0).astype(np.int64)
+        flipped = delta != 0
+        if flipped.any():
+            updated.in_stock_counts = {dimension: counts.copy() for dimension, counts in self.in_stock_counts.items()}
+            for dimension in ("category", "brand"):
+                np.add.at(updated.in_stock_counts[dimension], self.codes[dimension][rows[flipped]], delta[flipped])
+            for row, row_delta in zip(rows[flipped].tolist(), delta[flipped].tolist()):
+                start, end = self.row_tag_offsets[row], self.row_tag_offsets[row + 1]
+                np.add.at(updated.in_stock_counts["tag"], self.row_tag_codes[start:end], row_delta)
+        
+        moved = rows[(new_rating != self.rating[rows]) | (new_stock != self.stock[rows])]
+        updated.price = self.price.copy()
+        updated.price[rows] = new_price
+        updated.rating = self.rating.copy()
+        updated.rating[rows] = new_rating
+        updated.stock = self.stock.copy()
+        updated.stock[rows] = new_stock
+        
+        if len(moved) > self.RERANK_INCREMENTAL_MAX:
+            updated._rank_all()
+        elif len(moved):
+            # Take the moved rows out, then bisect each back in under its new key
+            is_moved = np.zeros(len(self.product_ids), dtype=bool)
+            is_moved[moved] = True
+            kept = self.by_rank[~is_moved[self.by_rank]]
+            moved = np.array(sorted(moved.tolist(), key=updated._rank_key), dtype=np.int64)
+            kept_keys = _RankKeys(updated, kept)
+            positions = [bisect.bisect_left(kept_keys, updated._rank_key(row)) for row in moved.tolist()]
+            updated.by_rank = np.insert(kept, positions, moved)
+        return updated
+    
+    def any_of(self, dimension: str, values: List[str]):
+        import numpy as np
+        
+        result = np.zeros(len(self.product_ids), dtype=bool)
+        for value in values:
+            bitmap = self.bitmaps[dimension].get(normalize_tag(value))
+            if bitmap is not None:
+                result |= bitmap
+        return result
+    
+    def all_of(self, dimension: str, values: List[str]):
+        import numpy as np
+        
+        result = np.ones(len(self.product_ids), dtype=bool)
+        for value in values:
+            bitmap = self.bitmaps[dimension].get(normalize_tag(value))
+            if bitmap is None:
+                return np.zeros(len(self.product_ids), dtype=bool)
+            result &= bitmap
+        return result
+    
+    def select(self, categories: List[str] = (), brands: List[str] = (), tags: List[str] = (), match_all_tags: bool = True,
+               min_price: Optional[float] = None, max_price: Optional[float] = None,
+               min_rating: Optional[float] = None, in_stock: bool = False):
+        """Bool mask of the rows passing every filter; values within one filter are OR-ed, except tags by default"""
+        import numpy as np
+        
+        mask = np.ones(len(self.product_ids), dtype=bool)
+        if categories:
+            mask &= self.any_of("category", categories)
+        if brands:
+            mask &= self.any_of("brand", brands)
+        if tags:
+            mask &= self.all_of("tag", tags) if match_all_tags else self.any_of("tag", tags)
+        if min_price is not None:
+            mask &= self.price >= min_price
+        if max_price is not None:
+            mask &= self.price <= max_price
+        if min_rating is not None:
+            mask &= self.rating >= min_rating
+        if in_stock:
+            mask &= self.stock > 0
+        return mask
+    
+    def rows_of(self, product_ids: List[int]):
+        """Row positions of the given ids, skipping ids the index doesn't know"""
+        import numpy as np
+        
+        ids = np.asarray(product_ids, dtype=np.int64)
+        rows = np.searchsorted(self.product_ids, ids)
+        rows = np.minimum(rows, max(len(self.product_ids) - 1, 0))
+        known = (self.product_ids[rows] == ids) if len(self.product_ids) else np.zeros(len(ids), dtype=bool)
+        return rows[known]
+    
+    def mask_of(self, product_ids: List[int]):
+        import numpy as np
+        
+        mask = np.zeros(len(self.product_ids), dtype=bool)
+        mask[self.rows_of(product_ids)] = True
+        return mask
+    
+    def contains(self, mask, product_id: int) -> bool:
+        rows = self.rows_of([product_id])
+        return bool(len(rows)) and bool(mask[rows[0]])
+    
+    def ranked_ids(self, mask, offset: int = 0, limit: Optional[int] = None) -> List[int]:
+        ranked = self.by_rank[mask[self.by_rank]]
+        end = None if limit is None else offset + limit
+        return self.product_ids[ranked[offset:end]].tolist()
+    
+    def facet_counts(self, mask, dimension: str, limit: Optional[int] = None) -> List[dict]:
+        import numpy as np
+        
+        counts = [int(np.count_nonzero(self.bitmaps[dimension][key] & mask)) for key in self.keys[dimension]]
+        return self._facet_list(dimension, counts, limit)
+    
+    def counter_facets(self, dimension: str, in_stock: bool = False, limit: Optional[int] = None) -> List[dict]:
+        """Facet counts for the unfiltered catalog, read straight from the counters"""
+        counts = (self.in_stock_counts if in_stock else self.totals)[dimension].tolist()
+        return self._facet_list(dimension, counts, limit)
+    
+    def _facet_list(self, dimension: str, counts: List[int], limit: Optional[int]) -> List[dict]:
+        facets = [
+            {"value": self.labels[dimension][key], "count": count}
+            for key, count in zip(self.keys[dimension], counts) if count
+        ]
+        facets.sort(key=lambda facet: (-facet["count"], facet["value"]))
+        return facets[:limit]
+    
+    def category_stats(self) -> List[dict]:
+        stats = []
+        for code, key in enumerate(self.keys["category"]):
+            count = int(self.totals["category"][code])
+            if count:
+                stats.append({
+                    "category": self.labels["category"][key],
+                    "count": count,
+                    "avg_price": round(float(self.price_sums[code]) / count, 2),
+                    "avg_rating": round(float(self.rating_sums[code]) / count, 1),
+                })
+        return sorted(stats, key=lambda stat: stat["category"])
+
+filter_index: Optional[FilterIndex] = None
+filter_index_lock = threading.Lock()
+
+def get_filter_index(db: Session) -> FilterIndex:
+    """The catalog filter index, built on first use and kept current from the change log"""
+    global filter_index
+    product_change_feed.sync(db)
+    if CATALOG_SNAPSHOT_PATH:
+        refresh_from_snapshot(db)
+    if filter_index is None:
+        with filter_index_lock:
+            if filter_index is None:
+                filter_index = FilterIndex.build(db)
+    return filter_index
+
+def split_filter_values(values: Optional[List[str]]) -> List[str]:
+    """Accept both repeated parameters and comma-separated lists"""
+    return [part.strip() for value in values or [] for part in value.split(",") if part.strip()]
+
+def ranked_text_matches(db: Session, index: FilterIndex, mask, text_filter, count: int) -> List[int]:
+    """First `count` ids, in rank order, among filtered rows that satisfy a SQL text filter.
+
+    The best-ranked candidates are checked in growing chunks, which answers
+    broad terms after one or two small queries. Past FILTER_PROBE_LIMIT
+    candidates one full scan finds every match instead.
+    """
+    ranked = index.ranked_ids(mask)
+    found = []
+    start, size = 0, max(count * 10, 100)
+    while start < len(ranked):
+        if start >= FILTER_PROBE_LIMIT:
+            matched = index.mask_of(db.execute(select(Product.id).where(text_filter)).scalars().all())
+            return index.ranked_ids(mask & matched, 0, count)
+        chunk = ranked[start:start + min(size, FILTER_IN_CLAUSE_MAX)]
+        matched = set(db.execute(select(Product.id).where(Product.id.in_(chunk), text_filter)).scalars())
+        found.extend(product_id for product_id in chunk if product_id in matched)
+        if len(found) >= count:
+            break
+        start += len(chunk)
+        size *= 4
+    return found[:count]
+
+def load_products_in_order(db: Session, product_ids: List[int]) -> List[Product]:
+    if not product_ids:
+        return []
+    by_id = {p.id: p for p in db.query(Product).filter(Product.id.in_(product_ids)).all()}
+    return [by_id[product_id] for product_id in product_ids if product_id in by_id]
+
+# Product changes
+# Stock, price and rating updates go through apply_product_updates, which
+# writes the new values and one product_changes row per product in the same
+# transaction. Each worker process polls that log by sequence number (on the
+# request path, at most every PRODUCT_CHANGE_POLL_SECONDS) and applies new
+# rows to its in-process structures instead of rebuilding them. Rows carry
+# absolute values, so applying one twice is harmless.
+PRODUCT_CHANGE_POLL_SECONDS = float(os.getenv("PRODUCT_CHANGE_POLL_SECONDS", "1.0"))
+PRODUCT_CHANGE_RETENTION = int(os.getenv("PRODUCT_CHANGE_RETENTION", "100000"))
+PRODUCT_BATCH_MAX_UPDATES = int(os.getenv("PRODUCT_BATCH_MAX_UPDATES", "1000"))
+
+class ProductChangeFeed:
+    """Follows the product_changes log and hands new rows to subscribers in order"""
+    
+    def __init__(self, poll_seconds: float = PRODUCT_CHANGE_POLL_SECONDS):
+        self.poll_seconds = poll_seconds
+        self.last_seq: Optional[int] = None
+        self.next_poll = 0.0
+        self.lock = threading.Lock()
+        # (apply(changes), reset()) pairs
+        self.subscribers = []
+    
+    def subscribe(self, apply: Callable, reset: Callable):
+        self.subscribers.append((apply, reset))
+    
+    def sync(self, db: Session, force: bool = False):
+        """Apply log rows written since the last sync, by this or any other worker"""
+        if not force and time.monotonic() < self.next_poll:
+            return
+        with self.lock:
+            self.next_poll = time.monotonic() + self.poll_seconds
+            if self.last_seq is None:
+                # Nothing is built yet; whatever gets built next reads current rows
+                self.last_seq = db.execute(select(func.coalesce(func.max(ProductChange.seq), 0))).scalar()
+                return
+            changes = db.execute(
+                select(ProductChange.seq, ProductChange.product_id, ProductChange.price, ProductChange.rating, ProductChange.stock)
+                .where(ProductChange.seq > self.last_seq).order_by(ProductChange.seq)
+            ).all()
+            if not changes:
+                return
+            # A gap means the rows we needed were pruned; so does a bulk load marker
+            if changes[0].seq != self.last_seq + 1 or any(change.product_id is None for change in changes):
+                for _, reset in self.subscribers:
+                    reset()
+            else:
+                for apply, _ in self.subscribers:
+                    apply(changes)
+            self.last_seq = changes[-1].seq
+
+product_change_feed = ProductChangeFeed()
+
+def _apply_filter_index_changes(changes):
+    global filter_index
+    with filter_index_lock:
+        if filter_index is not None:
+            filter_index = filter_index.with_changes(changes)
+
+def _reset_filter_index():
+    global filter_index
+    with filter_index_lock:
+        filter_index = None
+
+product_change_feed.subscribe(_apply_filter_index_changes, _reset_filter_index)
+
+# Price is one of the similarity features. The neighbor lists are shared rows,
+# so only the worker that wrote a change recomputes them (refresh_repriced_neighbors);
+# every other worker just notes which products its in-memory copy is stale for.
+# No similarity_lock here: a full rebuild can hold it for minutes, and the feed
+# syncs on the search path.
+def _note_similarity_changes(changes):
+    import numpy as np
+    
+    index = similarity_index
+    if index is None:
+        return
+    for change in changes:
+        row = index.row_of.get(change.product_id)
+        if row is not None and change.price is not None and not np.isclose(index.log_price[row], np.log1p(change.price)):
+            similarity_pending.add(change.product_id)
+
+def _reset_similarity_index():
+    global similarity_index
+    similarity_index = None
+    similarity_pending.clear()
+
+product_change_feed.subscribe(_note_similarity_changes, _reset_similarity_index)
+
+def log_catalog_reload(conn):
+    """Tell every worker to rebuild, e.g. after products were added in bulk"""
+    conn.execute(insert(ProductChange), [{"product_id": None}])
+
+def apply_product_updates(db: Session, updates: List[tuple]) -> Tuple[List[int], List[int]]:
+    """Apply (product_id, values) updates and log them in one transaction.
+
+    `values` holds any of price, rating and stock, or stock_delta to adjust
+    stock atomically (never below zero). Returns (updated ids, missing ids).
+    """
+    conn = db.connection()
+    updated, missing, log_rows = [], [], []
+    for product_id, values in updates:
+        values = dict(values)
+        stock_delta = values.pop("stock_delta", None)
+        if stock_delta is not None:
+            values["stock"] = func.max(Product.stock + stock_delta, 0)
+        row = conn.execute(
+            update(Product.__table__).where(Product.id == product_id).values(**values)
+            .returning(Product.id, Product.price, Product.rating, Product.stock)
+        ).first()
+        if row is None:
+            missing.append(product_id)
+            continue
+        updated.append(product_id)
+        log_rows.append({"product_id": row.id, "price": row.price, "rating": row.rating, "stock": row.stock})
+    if log_rows:
+        conn.execute(insert(ProductChange), log_rows)
+        newest = conn.execute(select(func.max(ProductChange.seq))).scalar()
+        conn.execute(ProductChange.__table__.delete().where(ProductChange.seq <= newest - PRODUCT_CHANGE_RETENTION))
+    db.commit()
+    # Apply our own changes now rather than on the next poll
+    product_change_feed.sync(db, force=True)
+    return updated, missing
+
+def product_update_values(update: "ProductUpdate") -> dict:
+    values = update.model_dump(exclude_none=True, include={"price", "rating", "stock", "stock_delta"})
+    if not values:
+        raise HTTPException(status_code=400, detail="Nothing to update")
+    if "stock" in values and "stock_delta" in values:
+        raise HTTPException(status_code=400, detail="Use either stock or stock_delta, not both")
+    if values.get("price", 0) < 0:
+        raise HTTPException(status_code=400, detail="price must not be negative")
+    if not 0 <= values.get("rating", 0) <= 5:
+        raise HTTPException(status_code=400, detail="rating must be between 0 and 5")
+    if values.get("stock", 0) < 0:
+        raise HTTPException(status_code=400, detail="stock must not be negative")
+    return values
+
+# Catalog snapshot
+# With several uvicorn workers every process would otherwise build its own
+# FilterIndex. `python api/main.py build-snapshot` (or POST
+# /admin/snapshot/rebuild) writes the index into one versioned file of flat
+# arrays plus a string table; workers map it read-only, so its pages are
+# shared through the page cache instead of copied per process. Rebuilds are
+# swapped in with os.replace and picked up on each worker's next check.
+CATALOG_SNAPSHOT_PATH = os.getenv("CATALOG_SNAPSHOT_PATH", "")
+CATALOG_SNAPSHOT_CHECK_SECONDS = float(os.getenv("CATALOG_SNAPSHOT_CHECK_SECONDS", "1.0"))
+SNAPSHOT_MAGIC = b"CATSNAP\0"
+SNAPSHOT_FORMAT = 1
+SNAPSHOT_ALIGN = 64
+
+def write_catalog_snapshot(db: Session, path: str = CATALOG_SNAPSHOT_PATH) -> dict:
+    """Build the filter index from the database and write it as a snapshot file.
+
+    The version is the change-log position read before the catalog, so
+    workers replay anything newer on top of it.
+    """
+    import numpy as np
+    
+    version = db.execute(select(func.coalesce(func.max(ProductChange.seq), 0))).scalar()
+    index = FilterIndex.build(db)
+    
+    strings = []
+    for dimension in FilterIndex.DIMENSIONS:
+        strings.extend(index.keys[dimension])
+        strings.extend(index.labels[dimension][key] for key in index.keys[dimension])
+    encoded = [value.encode("utf-8") for value in strings]
+    arrays = {
+        "product_ids": index.product_ids,
+        "price": index.price,
+        "rating": index.rating,
+        "stock": index.stock,
+        "by_rank": index.by_rank,
+        "codes_category": index.codes["category"],
+        "codes_brand": index.codes["brand"],
+        "row_tag_offsets": index.row_tag_offsets,
+        "row_tag_codes": index.row_tag_codes,
+        "price_sums": index.price_sums,
+        "rating_sums": index.rating_sums,
+        "string_offsets": np.cumsum([0] + [len(value) for value in encoded], dtype=np.int64),
+        "string_data": np.frombuffer(b"".join(encoded), dtype=np.uint8),
+    }
+    for dimension in FilterIndex.DIMENSIONS:
+        arrays[f"totals_{dimension}"] = index.totals[dimension]
+        arrays[f"in_stock_{dimension}"] = index.in_stock_counts[dimension]
+        keys = index.keys[dimension]
+        arrays[f"bitmaps_{dimension}"] = (
+            np.stack([index.bitmaps[dimension][key] for key in keys])
+            if keys else np.zeros((0, len(index.product_ids)), dtype=bool)
+        )
+    
+    # Lay arrays out after the header, each aligned so it can be viewed in place
+    layout = {}
+    offset = 0
+    for name, array in arrays.items():
+        array = np.ascontiguousarray(array)
+        arrays[name] = array
+        layout[name] = [array.dtype.str, list(array.shape), offset]
+        offset += -(-array.nbytes // SNAPSHOT_ALIGN) * SNAPSHOT_ALIGN
+    header = {
+        "format": SNAPSHOT_FORMAT,
+        "version": version,
+        "built_at": datetime.utcnow().isoformat(),
+        "key_counts": {dimension: len(index.keys[dimension]) for dimension in FilterIndex.DIMENSIONS},
+        "arrays": layout,
+    }
+    header_bytes = json.dumps(header).encode()
+    data_start = -(-(len(SNAPSHOT_MAGIC) + 8 + len(header_bytes)) // SNAPSHOT_ALIGN) * SNAPSHOT_ALIGN
+    
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(SNAPSHOT_MAGIC)
+        f.write(len(header_bytes).to_bytes(8, "little"))
+        f.write(header_bytes)
+        for name, array in arrays.items():
+            f.seek(data_start + layout[name][2])
+            f.write(array.tobytes())
+        f.truncate(data_start + offset)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    return {"version": version, "products": len(index.product_ids), "bytes": data_start + offset}
+
+def load_catalog_snapshot(path: str) -> Optional[FilterIndex]:
+    """Map a snapshot file as a FilterIndex whose arrays are read-only views of the file"""
+    import mmap
+    import numpy as np
+    
+    try:
+        with open(path, "rb") as f:
+            identity = os.fstat(f.fileno())
+            mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (FileNotFoundError, ValueError):
+        return None
+    if mapping[:len(SNAPSHOT_MAGIC)] != SNAPSHOT_MAGIC:
+        return None
+    header_length = int.from_bytes(mapping[len(SNAPSHOT_MAGIC):len(SNAPSHOT_MAGIC) + 8], "little")
+    header_end = len(SNAPSHOT_MAGIC) + 8 + header_length
+    header = json.loads(mapping[len(SNAPSHOT_MAGIC) + 8:header_end])
+    if header.get("format") != SNAPSHOT_FORMAT:
+        return None
+    data_start = -(-header_end // SNAPSHOT_ALIGN) * SNAPSHOT_ALIGN
+    
+    def view(name):
+        dtype, shape, offset = header["arrays"][name]
+        count = int(np.prod(shape)) if shape else 1
+        return np.frombuffer(mapping, dtype=np.dtype(dtype), count=count, offset=data_start + offset).reshape(shape)
+    
+    index = FilterIndex()
+    index.product_ids = view("product_ids")
+    index.price = view("price")
+    index.rating = view("rating")
+    index.stock = view("stock")
+    index.by_rank = view("by_rank")
+    index.codes = {"category": view("codes_category"), "brand": view("codes_brand")}
+    index.row_tag_offsets = view("row_tag_offsets")
+    index.row_tag_codes = view("row_tag_codes")
+    index.price_sums = view("price_sums")
+    index.rating_sums = view("rating_sums")
+    
+    string_offsets = view("string_offsets").tolist()
+    string_data = view("string_data")
+    strings = iter(bytes(string_data[start:end]).decode("utf-8") for start, end in zip(string_offsets, string_offsets[1:]))
+    for dimension in FilterIndex.DIMENSIONS:
+        count = header["key_counts"][dimension]
+        keys = [next(strings) for _ in range(count)]
+        labels = [next(strings) for _ in range(count)]
+        index.keys[dimension] = keys
+        index.labels[dimension] = dict(zip(keys, labels))
+        bitmaps = view(f"bitmaps_{dimension}")
+        index.bitmaps[dimension] = {key: bitmaps[code] for code, key in enumerate(keys)}
+        index.totals[dimension] = view(f"totals_{dimension}")
+        index.in_stock_counts[dimension] = view(f"in_stock_{dimension}")
+    index.snapshot_version = header["version"]
+    index.snapshot_id = (identity.st_ino, identity.st_mtime_ns)
+    return index
+
+snapshot_next_check = 0.0
+snapshot_rejected = None
+
+def refresh_from_snapshot(db: Session):
+    """Swap in the snapshot file if it is newer than the index this worker holds"""
+    global filter_index, snapshot_next_check, snapshot_rejected
+    if time.monotonic() < snapshot_next_check:
+        return
+    snapshot_next_check = time.monotonic() + CATALOG_SNAPSHOT_CHECK_SECONDS
+    try:
+        stat = os.stat(CATALOG_SNAPSHOT_PATH)
+    except FileNotFoundError:
+        return
+    identity = (stat.st_ino, stat.st_mtime_ns)
+    current = filter_index
+    if identity == snapshot_rejected or (current is not None and current.snapshot_id == identity):
+        return
+    index = load_catalog_snapshot(CATALOG_SNAPSHOT_PATH)
+    if index is None:
+        snapshot_rejected = identity
+        return
+    # Holding the feed lock keeps the feed from updating the index we replace
+    with product_change_feed.lock:
+        changes = db.execute(
+            select(ProductChange.seq, ProductChange.product_id, ProductChange.price, ProductChange.rating, ProductChange.stock)
+            .where(ProductChange.seq > index.snapshot_version).order_by(ProductChange.seq)
+        ).all()
+        if changes and (changes[0].seq != index.snapshot_version + 1 or any(change.product_id is None for change in changes)):
+            # Older than the retained log or than a bulk load; keep what we have
+            snapshot_rejected = identity
+            return
+        if changes:
+            index = index.with_changes(changes)
+            if index is None:
+                snapshot_rejected = identity
+                return
+        with filter_index_lock:
+            filter_index = index
+
+# Chat retention
+# Sessions idle longer than CHAT_RETENTION_DAYS are written to gzip NDJSON
+# archives (one file per day of last activity, one line per session), then
+# deleted in batches. chat_archive_index remembers which file holds each
+# session so it can be read back on demand.
+CHAT_RETENTION_DAYS = float(os.getenv("CHAT_RETENTION_DAYS", "90"))
+CHAT_ARCHIVE_DIR = os.getenv("CHAT_ARCHIVE_DIR", "./chat_archive")
+CHAT_COMPACTION_BATCH = int(os.getenv("CHAT_COMPACTION_BATCH", "500"))
+
+def chat_archive_path(day: str, archive_dir: Optional[str] = None) -> str:
+    return os.path.join(archive_dir or CHAT_ARCHIVE_DIR, f"chat-{day}.ndjson.gz")
+
+def _append_archive(path: str, lines: List[str]):
+    # Appending adds a new gzip member; readers see one continuous stream
+    with open(path, "ab") as raw:
+        with gzip.GzipFile(fileobj=raw, mode="wb") as archive:
+            archive.write(("\n".join(lines) + "\n").encode("utf-8"))
+        raw.flush()
+        os.fsync(raw.fileno())
+
+def compact_chat_history(db: Session, older_than_days: float = CHAT_RETENTION_DAYS, batch_size: int = CHAT_COMPACTION_BATCH, archive_dir: Optional[str] = None, vacuum: bool = True) -> dict:
+    """Archive and delete idle sessions, then hand freed pages back to the filesystem.
+
+    Archives are written and fsynced before rows are deleted, so a crash can
+    at worst archive a session twice; readers keep the last copy.
+    """
+    if older_than_days <= 0:
+        raise ValueError("older_than_days must be positive")
+    archive_dir = archive_dir or CHAT_ARCHIVE_DIR
+    os.makedirs(archive_dir, exist_ok=True)
+    cutoff = datetime.utcnow() - timedelta(days=older_than_days)
+    archived_sessions = archived_messages = 0
+    
+    while True:
+        # Plain updated_at (never NULL since migration 4) so this walks ix_chat_sessions_updated_at
+        sessions = db.query(ChatSession).filter(ChatSession.updated_at < cutoff).order_by(ChatSession.updated_at).limit(batch_size).all()
+        if not sessions:
+            break
+        session_ids = [s.id for s in sessions]
+        
+        messages_by_session = {}
+        for m in db.query(ChatMessage).filter(ChatMessage.session_id.in_(session_ids)).order_by(ChatMessage.timestamp):
+            messages_by_session.setdefault(m.session_id, []).append({
+                "id": m.id,
+                "sender": m.sender,
+                "content": m.content,
+                "timestamp": m.timestamp.isoformat() if m.timestamp else None,
+                "product_ids": json.loads(m.products_data) if m.products_data else [],
+            })
+        
+        lines_by_day = {}
+        index_rows = []
+        for s in sessions:
+            day = s.updated_at.date().isoformat()
+            messages = messages_by_session.get(s.id, [])
+            archived_messages += len(messages)
+            lines_by_day.setdefault(day, []).append(json.dumps({
+                "session_id": s.id,
+                "user_id": s.user_id,
+                "created_at": s.created_at.isoformat() if s.created_at else None,
+                "updated_at": s.updated_at.isoformat() if s.updated_at else None,
+                "messages": messages,
+            }, separators=(",", ":")))
+            index_rows.append({"session_id": s.id, "user_id": s.user_id, "archive_day": day, "message_count": len(messages)})
+        
+        for day, lines in lines_by_day.items():
+            _append_archive(chat_archive_path(day, archive_dir), lines)
+        
+        db.query(ChatArchiveEntry).filter(ChatArchiveEntry.session_id.in_(session_ids)).delete(synchronize_session=False)
+        db.execute(insert(ChatArchiveEntry), index_rows)
+        db.query(ChatMessage).filter(ChatMessage.session_id.in_(session_ids)).delete(synchronize_session=False)
+        db.query(ChatSession).filter(ChatSession.id.in_(session_ids)).delete(synchronize_session=False)
+        db.commit()
+        db.expunge_all()
+        archived_sessions += len(sessions)
+    
+    result = {"archived_sessions": archived_sessions, "archived_messages": archived_messages, "cutoff": cutoff.isoformat()}
+    if vacuum:
+        result["freed_pages"] = reclaim_free_pages()
+    return result
+
+def enable_incremental_vacuum() -> bool:
+    """Switch the database to auto_vacuum=INCREMENTAL; True if it was not already.
+
+    The switch only takes effect after a full VACUUM, which rewrites the whole
+    file and blocks every writer meanwhile, so it runs from the `migrate`
+    command and never inside a request.
+    """
+    with engine.connect() as conn:
+        conn = conn.execution_options(isolation_level="AUTOCOMMIT")
+        if conn.exec_driver_sql("PRAGMA auto_vacuum").scalar() == 2:
+            return False
+        conn.exec_driver_sql("PRAGMA auto_vacuum = INCREMENTAL")
+        conn.exec_driver_sql("VACUUM")
+    return True
+
+def reclaim_free_pages() -> int:
+    """Run an incremental vacuum and return how many pages it gave back"""
+    with engine.connect() as conn:
+        conn = conn.execution_options(isolation_level="AUTOCOMMIT")
+        if conn.exec_driver_sql("PRAGMA auto_vacuum").scalar() != 2:
+            logger.warning("auto_vacuum is not INCREMENTAL; run `python api/main.py migrate` to enable it")
+            return 0
+        pages_before = conn.exec_driver_sql("PRAGMA page_count").scalar()
+        # The pragma frees one page per step, but a cursor with no result
+        # columns is only stepped once; executescript runs it to completion
+        conn.connection.dbapi_connection.executescript("PRAGMA incremental_vacuum")
+        pages_after = conn.exec_driver_sql("PRAGMA page_count").scalar()
+    return pages_before - pages_after
+
+def read_archived_session(db: Session, session_id: str) -> Optional[dict]:
+    entry = db.get(ChatArchiveEntry, session_id)
+    if entry is None:
+        return None
+    path = chat_archive_path(entry.archive_day)
+    if not os.path.exists(path):
+        return None
+    record = None
+    with gzip.open(path, "rt", encoding="utf-8") as archive:
+        for line in archive:
+            # Cheap substring test before paying for a JSON parse
+            if session_id in line:
+                candidate = json.loads(line)
+                if candidate["session_id"] == session_id:
+                    record = candidate
+    return record
+
 if __name__ == "__main__":
-    import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
+    import argparse
+    
+    parser = argparse.ArgumentParser(description="E-commerce Chatbot API")
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.add_parser("migrate", help="Create tables and apply pending schema migrations")
+    seed_parser = subparsers.add_parser("seed", help="Migrate, then load sample products into an empty catalog")
+    seed_parser.add_argument("--count", type=int, default=150, help="Total number of products to generate")
+    seed_parser.add_argument("--seed", type=int, default=None, help="Random seed for reproducible catalogs")
+    subparsers.add_parser("build-similar", help="Recompute every product's similar-products list")
+    subparsers.add_parser("build-embeddings", help="Rebuild the memory-mapped semantic search index")
+    snapshot_parser = subparsers.add_parser("build-snapshot", help="Write the memory-mapped catalog snapshot shared by workers")
+    snapshot_parser.add_argument("--path", default=CATALOG_SNAPSHOT_PATH or "./catalog.snapshot", help="Snapshot file (default: CATALOG_SNAPSHOT_PATH)")
+    compact_parser = subparsers.add_parser("compact-chats", help="Archive and delete idle chat sessions")
+    compact_parser.add_argument("--days", type=float, default=CHAT_RETENTION_DAYS, help="Archive sessions idle for longer than this")
+    compact_parser.add_argument("--no-vacuum", action="store_true", help="Skip the incremental vacuum afterwards")
+    args = parser.parse_args()
+    if args.command == "compact-chats" and args.days <= 0:
+        parser.error("--days must be positive")
+    
+    if args.command == "migrate":
+        print(f"Database at schema version {migrate_database()}")
+        if enable_incremental_vacuum():
+            print("Switched the database to auto_vacuum=INCREMENTAL")
+    elif args.command == "seed":
+        migrate_database()
+        db = SessionLocal()
+        try:
+            init_sample_data(db, count=args.count, seed=args.seed)
+            print(f"Catalog contains {db.query(Product).count()} products")
+        finally:
+            db.close()
+    elif args.command == "build-similar":
+        migrate_database()
+        db = SessionLocal()
+        try:
+            started = time.perf_counter()
+            count = build_similar_products(db)
+            print(f"Computed neighbors for {count} products in {time.perf_counter() - started:.1f}s")
+        finally:
+            db.close()
+    elif args.command == "build-embeddings":
+        migrate_database()
+        db = SessionLocal()
+        try:
+            started = time.perf_counter()
+            count = build_embedding_index(db)
+            print(f"Embedded {count} products into {EMBEDDING_INDEX_PATH} in {time.perf_counter() - started:.1f}s")
+        finally:
+            db.close()
+    elif args.command == "build-snapshot":
+        migrate_database()
+        db = SessionLocal()
+        try:
+            started = time.perf_counter()
+            result = write_catalog_snapshot(db, args.path)
+            print(f"Wrote snapshot version {result['version']} ({result['products']} products, {result['bytes'] / 1e6:.1f} MB) to {args.path} in {time.perf_counter() - started:.1f}s")
+        finally:
+            db.close()
+    elif args.command == "compact-chats":
+        migrate_database()
+        db = SessionLocal()
+        try:
+            print(json.dumps(compact_chat_history(db, older_than_days=args.days, vacuum=not args.no_vacuum)))
+        finally:
+            db.close()
+    else:
+        import uvicorn
+        uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
@@ -0,0 +1,411 @@
+"""Offline load test for the API.
+
+Builds a SQLite catalog of the requested size plus a synthetic user
+population, then replays a mixed workload against the FastAPI app through an
+in-process ASGI client (no sockets, no extra dependencies). Reports
+throughput, p50/p95/p99 latency and DB query counts per endpoint as JSON so
+runs can be compared for regressions.
+
+    python benchmarks/bench_api.py --products 100k --requests 5000 --output run.json
+    python benchmarks/bench_api.py --products 100k --baseline run.json
+"""
+import argparse
+import asyncio
+import contextvars
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+from datetime import timedelta
+from urllib.parse import urlencode
+
+API_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "api")
+
+# Relative weight of each operation in the mixed workload
+WORKLOAD = {
+    "search": 26,
+    "search_tags": 4,
+    "inventory": 3,
+    "featured": 8,
+    "trending": 8,
+    "categories": 5,
+    "brands": 4,
+    "login": 3,
+    "chat": 38,
+    "chat_batch": 4,
+}
+
+SEARCH_TERMS = ["", "laptop", "headphones", "camera", "pro", "wireless", "gaming", "smart", "premium", "watch"]
+CATEGORIES = ["Electronics", "Computers", "Audio", "Gaming", "Smart Home", "Cameras", "Wearables", "Accessories"]
+BRANDS = ["Apple", "Samsung", "Sony", "Dell", "Google", "Bose", "Logitech", "ASUS"]
+TAGS = ["premium", "wireless", "noise-canceling", "gaming", "laptop", "headphones", "camera", "audio"]
+
+# Multi-turn conversations; later turns reuse the session id returned by the first
+CONVERSATIONS = [
+    ["hi", "find me a laptop under $1500", "show me cheaper ones", "recommend the best one"],
+    ["I need wireless headphones", "anything from sony?", "compare prices"],
+    ["show me gaming consoles", "what about under $400", "suggest something popular"],
+    ["looking for a camera between $500 and $2000", "best rated cameras", "cheaper options please"],
+    ["recommend a smartwatch", "find apple watch", "what's the budget option"],
+    ["show me smart home devices", "find a security camera around $150"],
+]
+
+BENCH_PASSWORD = "bench-password"
+BENCH_ADMIN_TOKEN = "bench-admin-token"
+
+
+def parse_size(value):
+    """Accept plain integers or k/M suffixes, e.g. 1k, 100k, 1M"""
+    value = value.strip()
+    multiplier = {"k": 1_000, "K": 1_000, "m": 1_000_000, "M": 1_000_000}.get(value[-1])
+    if multiplier:
+        return int(float(value[:-1]) * multiplier)
+    return int(value)
+
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return 0.0
+    rank = max(0, min(len(sorted_values) - 1, int(round(pct / 100 * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[rank]
+
+
+class ASGIClient:
+    """Minimal in-process HTTP/1.1 client speaking ASGI directly to the app"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def request(self, method, path, query=None, json_body=None, form=None, headers=None):
+        body = b""
+        raw_headers = [(b"host", b"bench")]
+        if json_body is not None:
+            body = json.dumps(json_body).encode()
+            raw_headers.append((b"content-type", b"application/json"))
+        elif form is not None:
+            body = urlencode(form).encode()
+            raw_headers.append((b"content-type", b"application/x-www-form-urlencoded"))
+        raw_headers.append((b"content-length", str(len(body)).encode()))
+        for key, value in (headers or {}).items():
+            raw_headers.append((key.lower().encode(), value.encode()))
+
+        scope = {
+            "type": "http",
+            "asgi": {"version": "3.0"},
+            "http_version": "1.1",
+            "method": method,
+            "scheme": "http",
+            "path": path,
+            "raw_path": path.encode(),
+            "query_string": urlencode(query or {}, doseq=True).encode(),
+            "headers": raw_headers,
+            "client": ("127.0.0.1", 0),
+            "server": ("bench", 80),
+        }
+        request_sent = False
+        status = None
+        chunks = []
+
+        async def receive():
+            nonlocal request_sent
+            if not request_sent:
+                request_sent = True
+                return {"type": "http.request", "body": body, "more_body": False}
+            # Nothing else to send; block like an idle connection would
+            await asyncio.Event().wait()
+
+        async def send(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            elif message["type"] == "http.response.body":
+                chunks.append(message.get("body", b""))
+
+        await self.app(scope, receive, send)
+        return status, b"".join(chunks)
+
+
+class QueryCounter:
+    """Counts SQL statements per request via a SQLAlchemy engine event.
+
+    The counter object is shared through a context variable, so statements
+    executed in FastAPI's threadpool are attributed to the right request.
+    """
+
+    current = contextvars.ContextVar("bench_query_counter", default=None)
+
+    def __init__(self):
+        self.count = 0
+
+    @classmethod
+    def install(cls, engine):
+        from sqlalchemy import event
+
+        @event.listens_for(engine, "before_cursor_execute")
+        def _count(conn, cursor, statement, parameters, context, executemany):
+            counter = cls.current.get()
+            if counter is not None:
+                counter.count += 1
+
+
+def prepare_database(main, products, users, seed):
+    """Migrate and seed the catalog, then insert synthetic users sharing one password hash"""
+    from sqlalchemy import insert
+
+    main.migrate_database()
+    db = main.SessionLocal()
+    try:
+        started = time.perf_counter()
+        main.init_sample_data(db, count=products, seed=seed)
+        seed_seconds = time.perf_counter() - started
+        existing = db.query(main.User).filter(main.User.username.like("bench-user-%")).count()
+        if existing < users:
+            hashed = main.get_password_hash(BENCH_PASSWORD)
+            db.execute(insert(main.User), [
+                {"username": f"bench-user-{i}", "email": f"bench-user-{i}@example.com", "hashed_password": hashed}
+                for i in range(existing, users)
+            ])
+            db.commit()
+        return {
+            "products": db.query(main.Product).count(),
+            "users": users,
+            "seed_seconds": round(seed_seconds, 2),
+        }
+    finally:
+        db.close()
+
+
+class Workload:
+    def __init__(self, main, client, users, rng, products):
+        self.main = main
+        self.products = products
+        self.client = client
+        self.rng = rng
+        self.users = [f"bench-user-{i}" for i in range(users)]
+        self.tokens = {}
+        self.operations = list(WORKLOAD)
+        self.weights = [WORKLOAD[name] for name in self.operations]
+
+    def auth_headers(self, username):
+        token = self.tokens.get(username)
+        if token is None:
+            token = self.main.create_access_token({"sub": username}, expires_delta=timedelta(hours=12))
+            self.tokens[username] = token
+        return {"Authorization": f"Bearer {token}"}
+
+    def next_operation(self):
+        return self.rng.choices(self.operations, self.weights)[0]
+
+    async def run(self, name, record):
+        """Execute one operation, calling record(label, seconds, status, queries) per HTTP request"""
+        rng = self.rng
+        if name == "search":
+            query = {"q": rng.choice(SEARCH_TERMS), "limit": 20}
+            if rng.random() < 0.4:
+                query["category"] = rng.choice(CATEGORIES)
+            if rng.random() < 0.3:
+                query["brand"] = rng.choice(BRANDS)
+            if rng.random() < 0.5:
+                low = rng.choice([0, 50, 100, 300])
+                query["min_price"] = low
+                query["max_price"] = low + rng.choice([200, 500, 1500])
+            if rng.random() < 0.3:
+                query["min_rating"] = 4.0
+            if rng.random() < 0.5:
+                query["in_stock"] = "true"
+            await self._call(record, "GET /products/search", "GET", "/products/search", query=query)
+        elif name == "search_tags":
+            # Multi-valued filters, then the facet counts a filter sidebar would show
+            query = {
+                "tags": rng.sample(TAGS, rng.choice([1, 2])),
+                "brand": rng.sample(BRANDS, rng.choice([1, 2, 3])),
+                "tag_match": rng.choice(["all", "any"]),
+            }
+            if rng.random() < 0.5:
+                query["category"] = rng.sample(CATEGORIES, 2)
+            if rng.random() < 0.5:
+                query["max_price"] = rng.choice([300, 800, 2000])
+            await self._call(record, "GET /products/search", "GET", "/products/search", query=dict(query, limit=20))
+            await self._call(record, "GET /products/facets", "GET", "/products/facets", query=query)
+        elif name == "inventory":
+            # Sales and restocks; the search indexes apply these without a rebuild
+            headers = {"X-Admin-Token": BENCH_ADMIN_TOKEN}
+            if rng.random() < 0.7:
+                product_id = rng.randint(1, self.products)
+                await self._call(record, "PATCH /products/{id}", "PATCH", f"/products/{product_id}", json_body={"stock_delta": -1}, headers=headers)
+            else:
+                updates = [{"product_id": rng.randint(1, self.products), "stock": rng.randint(0, 100)} for _ in range(50)]
+                await self._call(record, "POST /products:batch-update", "POST", "/products:batch-update", json_body={"updates": updates}, headers=headers)
+        elif name == "featured":
+            await self._call(record, "GET /products/featured", "GET", "/products/featured")
+        elif name == "trending":
+            await self._call(record, "GET /products/trending", "GET", "/products/trending")
+        elif name == "categories":
+            await self._call(record, "GET /products/categories", "GET", "/products/categories")
+        elif name == "brands":
+            await self._call(record, "GET /products/brands", "GET", "/products/brands")
+        elif name == "login":
+            form = {"username": rng.choice(self.users), "password": BENCH_PASSWORD}
+            await self._call(record, "POST /auth/login", "POST", "/auth/login", form=form)
+        elif name == "chat":
+            headers = self.auth_headers(rng.choice(self.users))
+            session_id = None
+            for message in rng.choice(CONVERSATIONS):
+                payload = {"message": message, "session_id": session_id}
+                body = await self._call(record, "POST /chat/message", "POST", "/chat/message", json_body=payload, headers=headers)
+                if body:
+                    session_id = json.loads(body).get("session_id", session_id)
+        elif name == "chat_batch":
+            # Two whole conversations in one request; unknown session ids become new sessions
+            headers = self.auth_headers(rng.choice(self.users))
+            messages = [
+                {"message": message, "session_id": f"batch-conversation-{n}"}
+                for n, conversation in enumerate(rng.sample(CONVERSATIONS, 2))
+                for message in conversation
+            ]
+            await self._call(record, "POST /chat/messages:batch", "POST", "/chat/messages:batch", json_body={"messages": messages}, headers=headers)
+
+    async def _call(self, record, label, method, path, **kwargs):
+        counter = QueryCounter()
+        token = QueryCounter.current.set(counter)
+        started = time.perf_counter()
+        try:
+            status, body = await self.client.request(method, path, **kwargs)
+        finally:
+            QueryCounter.current.reset(token)
+        record(label, time.perf_counter() - started, status, counter.count)
+        return body if status == 200 else None
+
+
+async def run_benchmark(main, args, catalog):
+    client = ASGIClient(main.app)
+    await main.app.router.startup()
+    workload = Workload(main, client, args.users, random.Random(args.seed), catalog["products"])
+    stats = {}
+
+    def record(label, seconds, status, queries):
+        entry = stats.setdefault(label, {"latencies": [], "queries": [], "errors": 0})
+        entry["latencies"].append(seconds)
+        entry["queries"].append(queries)
+        if status is None or status >= 400:
+            entry["errors"] += 1
+
+    def discard(*_):
+        pass
+
+    for _ in range(args.warmup):
+        await workload.run(workload.next_operation(), discard)
+
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def worker(name):
+        async with semaphore:
+            await workload.run(name, record)
+
+    operations = [workload.next_operation() for _ in range(args.requests)]
+    started = time.perf_counter()
+    await asyncio.gather(*(worker(name) for name in operations))
+    elapsed = time.perf_counter() - started
+    await main.app.router.shutdown()
+
+    endpoints = {}
+    total_requests = 0
+    for label, entry in sorted(stats.items()):
+        latencies = sorted(entry["latencies"])
+        total_requests += len(latencies)
+        endpoints[label] = {
+            "requests": len(latencies),
+            "errors": entry["errors"],
+            "throughput_rps": round(len(latencies) / elapsed, 2),
+            "mean_ms": round(statistics.fmean(latencies) * 1000, 3),
+            "p50_ms": round(percentile(latencies, 50) * 1000, 3),
+            "p95_ms": round(percentile(latencies, 95) * 1000, 3),
+            "p99_ms": round(percentile(latencies, 99) * 1000, 3),
+            "queries_mean": round(statistics.fmean(entry["queries"]), 2),
+            "queries_max": max(entry["queries"]),
+        }
+
+    return {
+        "config": {
+            "products": args.products,
+            "users": args.users,
+            "requests": args.requests,
+            "concurrency": args.concurrency,
+            "seed": args.seed,
+            "workload": WORKLOAD,
+        },
+        "catalog": catalog,
+        "elapsed_seconds": round(elapsed, 3),
+        "throughput_rps": round(total_requests / elapsed, 2),
+        "endpoints": endpoints,
+    }
+
+
+def compare(results, baseline, max_regression):
+    """Print p95 deltas against a previous run; return True if any endpoint regressed"""
+    regressed = False
+    print(f"{'endpoint':<28}{'base p95':>12}{'p95':>12}{'delta':>10}", file=sys.stderr)
+    for label, current in results["endpoints"].items():
+        previous = baseline.get("endpoints", {}).get(label)
+        if not previous or not previous["p95_ms"]:
+            continue
+        delta = current["p95_ms"] / previous["p95_ms"] - 1
+        flag = ""
+        if delta > max_regression:
+            regressed = True
+            flag = "  REGRESSION"
+        print(f"{label:<28}{previous['p95_ms']:>12.2f}{current['p95_ms']:>12.2f}{delta:>+10.1%}{flag}", file=sys.stderr)
+    return regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--products", default="1k", help="Catalog size, e.g. 1k, 100k, 1M")
+    parser.add_argument("--users", type=int, default=100, help="Synthetic user population")
+    parser.add_argument("--requests", type=int, default=2000, help="Workload operations to replay")
+    parser.add_argument("--warmup", type=int, default=50)
+    parser.add_argument("--concurrency", type=int, default=1, help="Operations in flight at once")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--db", default=None, help="Reuse/create the SQLite catalog at this path (default: temporary)")
+    parser.add_argument("--output", default=None, help="Write JSON results here instead of stdout")
+    parser.add_argument("--baseline", default=None, help="Previous JSON results to compare p95 latency against")
+    parser.add_argument("--max-regression", type=float, default=0.2, help="Allowed p95 slowdown before failing (0.2 = 20%%)")
+    args = parser.parse_args()
+    args.products = parse_size(args.products)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = args.db or os.path.join(tmp, "bench.db")
+        # main reads DATABASE_URL at import time
+        os.environ["DATABASE_URL"] = f"sqlite:///{os.path.abspath(db_path)}"
+        os.environ["ADMIN_TOKEN"] = BENCH_ADMIN_TOKEN
+        # Measure chat itself; set these explicitly to benchmark the admission limits
+        os.environ.setdefault("CHAT_RATE_PER_MINUTE", "1000000")
+        os.environ.setdefault("CHAT_BURST", "1000000")
+        sys.path.insert(0, API_DIR)
+        import main as api
+
+        QueryCounter.install(api.engine)
+        catalog = prepare_database(api, args.products, args.users, args.seed)
+        results = asyncio.run(run_benchmark(api, args, catalog))
+        api.engine.dispose()
+
+    payload = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(payload)
+    else:
+        print(payload)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if compare(results, baseline, args.max_regression):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+"""CPU benchmark for the semantic search index.
+
+Seeds a catalog of each requested size, times the offline embedding build and
+then the per-query latency of the memory-mapped brute-force search.
+
+    python benchmarks/bench_embeddings.py --sizes 1k,100k --queries 200
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+from bench_api import API_DIR, parse_size, percentile
+
+QUERIES = [
+    "something to block noise on flights",
+    "camera for filming my trips",
+    "laptop for office work",
+    "quiet headphones for the commute",
+    "fitness tracker for running",
+    "console to play games with kids",
+    "smart speaker with voice control",
+    "cheap wireless earbuds",
+]
+
+
+def bench_size(main, size, queries, seed, tmp):
+    from sqlalchemy import delete
+
+    db = main.SessionLocal()
+    try:
+        db.execute(delete(main.Product))
+        db.commit()
+        main.init_sample_data(db, count=size, seed=seed)
+
+        path = os.path.join(tmp, f"embeddings-{size}.npy")
+        started = time.perf_counter()
+        built = main.build_embedding_index(db, path)
+        build_seconds = time.perf_counter() - started
+    finally:
+        db.close()
+
+    started = time.perf_counter()
+    index = main.EmbeddingIndex.load(path)
+    load_ms = (time.perf_counter() - started) * 1000
+
+    latencies = []
+    for i in range(queries):
+        started = time.perf_counter()
+        index.search(QUERIES[i % len(QUERIES)])
+        latencies.append(time.perf_counter() - started)
+    latencies.sort()
+
+    return {
+        "products": built,
+        "dim": main.EMBEDDING_DIM,
+        "index_mb": round(os.path.getsize(path) / 1e6, 2),
+        "build_seconds": round(build_seconds, 3),
+        "build_products_per_second": round(built / build_seconds, 1),
+        "load_ms": round(load_ms, 3),
+        "query_mean_ms": round(statistics.fmean(latencies) * 1000, 3),
+        "query_p50_ms": round(percentile(latencies, 50) * 1000, 3),
+        "query_p95_ms": round(percentile(latencies, 95) * 1000, 3),
+        "query_p99_ms": round(percentile(latencies, 99) * 1000, 3),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", default="1k,10k", help="Comma-separated catalog sizes, e.g. 1k,100k,1M")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", default=None, help="Write JSON results here instead of stdout")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(tmp, 'bench.db')}"
+        os.environ.setdefault("SLOW_QUERY_MS", "60000")
+        sys.path.insert(0, API_DIR)
+        import main as api
+
+        api.migrate_database()
+        results = [bench_size(api, parse_size(size), args.queries, args.seed, tmp) for size in args.sizes.split(",")]
+        api.engine.dispose()
+
+    payload = json.dumps({"sizes": results}, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(payload)
+    else:
+        print(payload)
+
+
+if __name__ == "__main__":
+    main()
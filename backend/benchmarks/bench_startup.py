@@ -0,0 +1,103 @@
+"""Import-time and cold-start benchmark for the API.
+
+Each sample runs in a fresh interpreter so module caches don't hide the cost
+a serverless cold start actually pays.
+
+    python benchmarks/bench_startup.py --runs 10 --output startup.json
+"""
+import argparse
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+
+API_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "api")
+
+# Runs inside the child interpreter; prints timings in milliseconds as JSON
+CHILD_SCRIPT = """
+import asyncio, json, sys, time
+t0 = time.perf_counter()
+sys.path.insert(0, {api_dir!r})
+import main
+t1 = time.perf_counter()
+asyncio.run(main.startup_event())
+t2 = time.perf_counter()
+heavy = [m for m in ("passlib", "jose") if m in sys.modules]
+print(json.dumps({{"import_ms": (t1 - t0) * 1000, "startup_ms": (t2 - t1) * 1000, "heavy_modules_loaded": heavy}}))
+"""
+
+
+def run_once(database_url):
+    env = dict(os.environ, DATABASE_URL=database_url)
+    out = subprocess.run(
+        [sys.executable, "-c", CHILD_SCRIPT.format(api_dir=API_DIR)],
+        env=env, capture_output=True, text=True, check=True
+    )
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+
+def top_imports(database_url, limit):
+    """Slowest modules by cumulative import time, from `python -X importtime`"""
+    env = dict(os.environ, DATABASE_URL=database_url)
+    out = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import sys; sys.path.insert(0, {API_DIR!r}); import main"],
+        env=env, capture_output=True, text=True, check=True
+    )
+    rows = []
+    for line in out.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|", 2)
+        rows.append({"module": name.strip(), "self_us": int(self_us), "cumulative_us": int(cumulative_us)})
+    rows.sort(key=lambda r: r["cumulative_us"], reverse=True)
+    return rows[:limit]
+
+
+def summarize(samples, key):
+    values = [s[key] for s in samples]
+    return {
+        "min": round(min(values), 2),
+        "median": round(statistics.median(values), 2),
+        "max": round(max(values), 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--database", default=None, help="SQLite file to copy for the run (default: fresh empty DB)")
+    parser.add_argument("--top", type=int, default=15, help="How many modules to list from -X importtime")
+    parser.add_argument("--output", default=None, help="Write JSON results here instead of stdout")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, "bench.db")
+        if args.database:
+            shutil.copyfile(args.database, db_path)
+        database_url = f"sqlite:///{db_path}"
+
+        # The first start migrates a fresh database; measure it separately
+        first = run_once(database_url)
+        samples = [run_once(database_url) for _ in range(args.runs)]
+        results = {
+            "runs": args.runs,
+            "first_start": first,
+            "import_ms": summarize(samples, "import_ms"),
+            "startup_ms": summarize(samples, "startup_ms"),
+            "heavy_modules_loaded": samples[-1]["heavy_modules_loaded"],
+            "top_imports": top_imports(database_url, args.top),
+        }
+
+    payload = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(payload)
+    else:
+        print(payload)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+"""Per-worker memory of the catalog filter index, with and without the shared snapshot.
+
+Starts N worker-like processes against one seeded catalog. Each loads the
+filter index, either built in-process or mapped from the snapshot file. Once
+all of them are up, each reports its own memory from /proc (Linux only):
+private bytes, which grow with every worker, and PSS, which splits shared
+pages between the processes mapping them.
+
+    python benchmarks/bench_workers.py --products 100k --workers 1,2,4,8
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+from bench_api import API_DIR, parse_size
+
+# Runs inside each worker process; reports memory in kB once told to
+CHILD_SCRIPT = """
+import json, sys
+sys.path.insert(0, {api_dir!r})
+import main
+
+def memory():
+    fields = {{}}
+    with open("/proc/self/smaps_rollup") as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) == 3 and parts[2] == "kB":
+                fields[parts[0].rstrip(":")] = int(parts[1])
+    return fields
+
+db = main.SessionLocal()
+before = memory()
+index = main.get_filter_index(db)
+for tags in (["premium"], ["wireless", "noise-canceling"]):
+    index.ranked_ids(index.select(tags=tags, min_price=50, in_stock=True), 0, 20)
+index.facet_counts(index.select(), "tag")
+db.close()
+print("ready", flush=True)
+sys.stdin.readline()
+after = memory()
+print(json.dumps({{
+    "mapped_snapshot": index.snapshot_id is not None,
+    "index_private_kb": (after["Private_Clean"] + after["Private_Dirty"]) - (before["Private_Clean"] + before["Private_Dirty"]),
+    "private_kb": after["Private_Clean"] + after["Private_Dirty"],
+    "pss_kb": after["Pss"],
+    "rss_kb": after["Rss"],
+}}), flush=True)
+"""
+
+
+def run_workers(count, env):
+    workers = [
+        subprocess.Popen(
+            [sys.executable, "-c", CHILD_SCRIPT.format(api_dir=API_DIR)],
+            env=env, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True
+        )
+        for _ in range(count)
+    ]
+    try:
+        # Measure only once every worker holds its index, so shared pages are split N ways
+        for worker in workers:
+            if worker.stdout.readline().strip() != "ready":
+                raise RuntimeError("worker failed to start")
+        for worker in workers:
+            worker.stdin.write("measure\n")
+            worker.stdin.flush()
+        return [json.loads(worker.stdout.readline()) for worker in workers]
+    finally:
+        for worker in workers:
+            worker.kill()
+            worker.wait()
+
+
+def summarize(samples):
+    count = len(samples)
+    return {
+        "workers": count,
+        "mapped_snapshot": all(s["mapped_snapshot"] for s in samples),
+        "index_private_mb_per_worker": round(sum(s["index_private_kb"] for s in samples) / count / 1024, 1),
+        "private_mb_per_worker": round(sum(s["private_kb"] for s in samples) / count / 1024, 1),
+        "pss_mb_total": round(sum(s["pss_kb"] for s in samples) / 1024, 1),
+        "rss_mb_per_worker": round(sum(s["rss_kb"] for s in samples) / count / 1024, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--products", default="100k", help="Catalog size, e.g. 10k or 1M")
+    parser.add_argument("--workers", default="1,2,4", help="Comma-separated worker counts")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", default=None, help="Write JSON results here instead of stdout")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        snapshot_path = os.path.join(tmp, "catalog.snapshot")
+        env = dict(os.environ, DATABASE_URL=f"sqlite:///{os.path.join(tmp, 'bench.db')}", SLOW_QUERY_MS="60000")
+        main_py = os.path.join(API_DIR, "main.py")
+        subprocess.run([sys.executable, main_py, "seed", "--count", str(parse_size(args.products)), "--seed", str(args.seed)],
+                       env=env, check=True, capture_output=True)
+        subprocess.run([sys.executable, main_py, "build-snapshot", "--path", snapshot_path], env=env, check=True, capture_output=True)
+
+        results = {"products": parse_size(args.products), "snapshot_mb": round(os.path.getsize(snapshot_path) / 1e6, 1), "runs": []}
+        for count in [int(n) for n in args.workers.split(",")]:
+            for mode, mode_env in (("per_process", dict(env, CATALOG_SNAPSHOT_PATH="")), ("snapshot", dict(env, CATALOG_SNAPSHOT_PATH=snapshot_path))):
+                results["runs"].append({"mode": mode, **summarize(run_workers(count, mode_env))})
+
+    payload = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(payload)
+    else:
+        print(payload)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,42 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+# main reads its configuration at import time, so point it at a scratch
+# database (and out of the way of the rate limiter) before importing it
+_workdir = tempfile.mkdtemp(prefix="chatbot-tests-")
+os.environ["DATABASE_URL"] = f"sqlite:///{_workdir}/test.db"
+os.environ.setdefault("CHAT_RATE_PER_MINUTE", "100000")
+os.environ.setdefault("CHAT_BURST", "100000")
+os.environ.setdefault("CHAT_ARCHIVE_DIR", os.path.join(_workdir, "chat_archive"))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "api"))
+
+import main  # noqa: E402
+
+
+@pytest.fixture(scope="session")
+def app():
+    main.migrate_database()
+    db = main.SessionLocal()
+    try:
+        main.init_sample_data(db, count=300, seed=1)
+    finally:
+        db.close()
+    return main.app
+
+
+@pytest.fixture(scope="session")
+def client(app):
+    from fastapi.testclient import TestClient
+
+    with TestClient(app) as client:
+        yield client
+
+
+@pytest.fixture(scope="session")
+def auth_headers(client):
+    client.post("/auth/register", json={"username": "shopper", "email": "shopper@example.com", "password": "secret"})
+    token = client.post("/auth/login", data={"username": "shopper", "password": "secret"}).json()["access_token"]
+    return {"Authorization": f"Bearer {token}"}
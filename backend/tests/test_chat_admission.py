@@ -0,0 +1,78 @@
+import asyncio
+import time
+
+import httpx
+import pytest
+
+import main
+
+
+@pytest.fixture
+def admission(monkeypatch):
+    """Swap in fresh buckets and gate; the gate's semaphore binds to the loop it first runs on"""
+    monkeypatch.setattr(main.chat_admission, "buckets", main.TokenBuckets(100000, 100000))
+    monkeypatch.setattr(main.chat_admission, "gate", main.ConcurrencyGate(1, 0, 1.0))
+    return main.chat_admission
+
+
+@pytest.fixture
+def pool_usage():
+    """Peak number of pooled connections checked out at once while the test runs"""
+    usage = {"current": 0, "peak": 0}
+    
+    def checkout(*args):
+        usage["current"] += 1
+        usage["peak"] = max(usage["peak"], usage["current"])
+    
+    def checkin(*args):
+        usage["current"] -= 1
+    
+    main.event.listen(main.engine, "checkout", checkout)
+    main.event.listen(main.engine, "checkin", checkin)
+    yield usage
+    main.event.remove(main.engine, "checkout", checkout)
+    main.event.remove(main.engine, "checkin", checkin)
+
+
+def test_flood_is_refused_without_touching_the_pool(app, auth_headers, admission, pool_usage):
+    async def flood():
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            return await asyncio.gather(*(
+                client.post("/chat/message", json={"message": "find me a laptop under $1000"}, headers=auth_headers)
+                for _ in range(20)
+            ))
+    
+    started = time.perf_counter()
+    responses = asyncio.run(flood())
+    elapsed = time.perf_counter() - started
+    
+    statuses = [r.status_code for r in responses]
+    assert set(statuses) <= {200, 429}
+    assert 200 in statuses and 429 in statuses
+    assert all(r.headers["Retry-After"] for r in responses if r.status_code == 429)
+    # Only admitted requests open a session, one at a time
+    assert pool_usage["peak"] <= 1
+    assert elapsed < 10
+
+
+def test_batch_is_charged_before_it_waits_for_a_slot(client, auth_headers, admission, monkeypatch):
+    monkeypatch.setattr(admission, "buckets", main.TokenBuckets(0, 3))
+    batch = {"messages": [{"message": "recommend headphones"}] * 5}
+    
+    # A full bucket admits a batch larger than the burst, leaving it in debt
+    assert client.post("/chat/messages:batch", json=batch, headers=auth_headers).status_code == 200
+    
+    # With the only slot taken, a user out of tokens still hears about the rate limit
+    assert asyncio.run(admission.gate.acquire())
+    try:
+        response = client.post("/chat/messages:batch", json=batch, headers=auth_headers)
+    finally:
+        admission.gate.release()
+    assert response.status_code == 429
+    assert response.json()["detail"] == "Too many chat messages, slow down"
+
+
+def test_invalid_token_is_rejected_before_admission(client):
+    response = client.post("/chat/message", json={"message": "hi"}, headers={"Authorization": "Bearer nope"})
+    assert response.status_code == 401
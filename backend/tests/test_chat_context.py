@@ -0,0 +1,51 @@
+import main
+
+
+def converse(client, headers, *messages):
+    """Send messages in one session; returns the responses and the stored context"""
+    session_id = None
+    responses = []
+    for message in messages:
+        response = client.post("/chat/message", json={"message": message, "session_id": session_id}, headers=headers)
+        assert response.status_code == 200, response.text
+        session_id = response.json()["session_id"]
+        responses.append(response.json())
+    db = main.SessionLocal()
+    try:
+        context = db.get(main.ChatSession, session_id).context
+    finally:
+        db.close()
+    return responses, main.ConversationState.from_json(context)
+
+
+NOTHING_ELSE = "I couldn't find anything else"
+
+
+def test_search_without_matches_keeps_no_context(client, auth_headers):
+    for follow_up in ["what about under $400", "anything from sony?"]:
+        responses, state = converse(client, auth_headers, "show me gaming consoles", follow_up)
+        assert responses[0]["response"].startswith("I couldn't find any products matching")
+        assert not responses[1]["response"].startswith(NOTHING_ELSE)
+        assert state is None
+
+
+def test_search_without_matches_keeps_previous_context(client, auth_headers):
+    responses, state = converse(client, auth_headers, "find me headphones", "show me gaming consoles", "anything from sony?")
+    assert responses[2]["response"] == "Here are the updated audio results:"
+    assert state.category == "Audio" and state.brand == "sony"
+
+
+def test_refinement_cues_in_a_new_question_start_a_new_search(client, auth_headers):
+    for message in ["show me other wireless chargers", "tell me more about the warranty"]:
+        responses, state = converse(client, auth_headers, "find me a laptop under $1000", message)
+        assert not responses[1]["response"].startswith("Here are a few more")
+        assert not responses[1]["response"].startswith(NOTHING_ELSE)
+        # Neither question found anything to replace the laptop search with
+        assert state.terms == ["laptop"]
+
+
+def test_follow_ups_refine_the_previous_search(client, auth_headers):
+    responses, state = converse(client, auth_headers, "find me headphones", "what about something from bose", "show me more headphones")
+    assert responses[1]["response"] == "Here are the updated audio results:"
+    assert all(p["brand"] == "Bose" for p in responses[1]["products"])
+    assert state.category == "Audio" and state.brand == "bose"
@@ -40,9 +40,12 @@ export const useChatStore = create((set, get) => ({
       addMessage(botMessage);
       set({ sessionId: response.session_id });
     } catch (error) {
+      const retryAfter = error.response?.status === 429 ? error.response.headers['retry-after'] : null;
       const errorMessage = {
         id: (Date.now() + 1).toString(),
-        content: 'Sorry, I encountered an error. Please try again.',
+        content: retryAfter
+          ? `You're sending messages a little fast. Please try again in ${retryAfter} seconds.`
+          : 'Sorry, I encountered an error. Please try again.',
         sender: 'bot',
         timestamp: new Date(),
       };